@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from db import db_instance
+from migrations import MAINTENANCE_TIMEOUT
+from models import DailyLoans, BookCirculation, GenreUtilization
+
+logger = logging.getLogger(__name__)
+
+# Статистика выдач. Триггеры book_loans пишут приращения в circulation_deltas,
+# а задание этого модуля сворачивает их в агрегаты:
+#     python analytics.py --interval 30
+# Отчеты читают только агрегаты, поэтому не сканируют book_loans и books.
+# Заданий может быть несколько: пачки приращений разбираются через
+# FOR UPDATE SKIP LOCKED. Отчеты отстают от выдач не больше чем на интервал.
+FOLD_BATCH = 10000
+
+async def fold_deltas(batch: int = FOLD_BATCH) -> int:
+    async with db_instance.acquire() as conn:
+        try:
+            # Агрегаты обновляются в порядке ключа, чтобы параллельные
+            # задания не взаимоблокировались
+            return await conn.fetchval(
+                '''WITH taken AS (
+                       DELETE FROM circulation_deltas WHERE id IN (
+                           SELECT id FROM circulation_deltas ORDER BY id
+                           LIMIT $1 FOR UPDATE SKIP LOCKED
+                       )
+                       RETURNING day, book_id, loans, returns
+                   ), daily AS (
+                       INSERT INTO loans_daily AS d (day, loans, returns)
+                       SELECT day, sum(loans), sum(returns) FROM taken
+                       GROUP BY day ORDER BY day
+                       ON CONFLICT (day) DO UPDATE
+                           SET loans = d.loans + excluded.loans,
+                               returns = d.returns + excluded.returns
+                   ), per_book AS (
+                       -- Жанр новой строки берется из книги, а существующей -
+                       -- из самой строки после ее блокировки: смена жанра
+                       -- переносит счетчики книги под той же блокировкой
+                       INSERT INTO book_circulation AS c (book_id, genre, loans, on_loan)
+                       SELECT t.book_id, coalesce(min(b.genre), ''),
+                              sum(t.loans), sum(t.loans - t.returns)
+                       FROM taken t LEFT JOIN books b ON b.id = t.book_id
+                       GROUP BY t.book_id ORDER BY t.book_id
+                       ON CONFLICT (book_id) DO UPDATE
+                           SET loans = c.loans + excluded.loans,
+                               on_loan = c.on_loan + excluded.on_loan
+                       RETURNING c.book_id, c.genre
+                   ), per_genre AS (
+                       INSERT INTO genre_circulation AS g (genre, loans, on_loan)
+                       SELECT p.genre, sum(t.loans), sum(t.loans - t.returns)
+                       FROM taken t JOIN per_book p ON p.book_id = t.book_id
+                       GROUP BY 1 ORDER BY 1
+                       ON CONFLICT (genre) DO UPDATE
+                           SET loans = g.loans + excluded.loans,
+                               on_loan = g.on_loan + excluded.on_loan
+                   )
+                   SELECT count(*) FROM taken''',
+                batch
+            )
+        except Exception as e:
+            logger.error("Ошибка при свертке статистики выдач: %s", e)
+            raise e
+
+async def fold_all(batch: int = FOLD_BATCH) -> int:
+    folded = 0
+    while True:
+        count = await fold_deltas(batch)
+        folded += count
+        if count < batch:
+            return folded
+
+async def rebuild():
+    # Полный пересчет по book_loans - для исправления расхождений.
+    # Блокирует выдачи на время пересчета
+    async with db_instance.acquire() as conn:
+        try:
+            async with conn.transaction():
+                await conn.execute('SET LOCAL statement_timeout = 0')
+                await conn.execute('''
+                    LOCK TABLE books, book_loans IN SHARE ROW EXCLUSIVE MODE;
+                    TRUNCATE circulation_deltas, loans_daily, book_circulation, genre_circulation;
+                    INSERT INTO loans_daily (day, loans, returns)
+                    SELECT day, sum(loans), sum(returns) FROM (
+                        SELECT loan_date::date AS day, count(*) AS loans, 0 AS returns
+                        FROM book_loans GROUP BY 1
+                        UNION ALL
+                        SELECT coalesce(return_date, loan_date)::date, 0, count(*)
+                        FROM book_loans WHERE is_returned GROUP BY 1
+                    ) d GROUP BY day;
+                    INSERT INTO book_circulation (book_id, genre, loans, on_loan)
+                    SELECT l.book_id, coalesce(min(b.genre), ''), count(*),
+                           count(*) FILTER (WHERE NOT l.is_returned)
+                    FROM book_loans l LEFT JOIN books b ON b.id = l.book_id
+                    GROUP BY l.book_id;
+                    INSERT INTO genre_circulation (genre, loans, on_loan)
+                    SELECT genre, sum(loans), sum(on_loan) FROM book_circulation GROUP BY genre;
+                ''', timeout=MAINTENANCE_TIMEOUT)
+            logger.info("Статистика выдач пересчитана")
+        except Exception as e:
+            logger.error("Ошибка при пересчете статистики выдач: %s", e)
+            raise e
+
+async def loans_per_day(days: int = 30):
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            rows = await conn.fetch(
+                '''SELECT day, loans, returns FROM loans_daily
+                   WHERE day > CURRENT_DATE - $1::int ORDER BY day''',
+                days
+            )
+            return [DailyLoans(*row) for row in rows]
+        except Exception as e:
+            logger.error("Ошибка при получении выдач по дням: %s", e)
+            raise e
+
+async def top_books(limit: int = 10):
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            rows = await conn.fetch(
+                '''SELECT c.book_id, b.title, c.loans, c.on_loan
+                   FROM book_circulation c JOIN books b ON b.id = c.book_id
+                   ORDER BY c.loans DESC, c.book_id LIMIT $1''',
+                limit
+            )
+            return [BookCirculation(*row) for row in rows]
+        except Exception as e:
+            logger.error("Ошибка при получении самых популярных книг: %s", e)
+            raise e
+
+async def genre_utilization():
+    # Доля экземпляров жанра, находящихся на руках
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            rows = await conn.fetch(
+                '''SELECT f.genre, f.copies, coalesce(c.on_loan, 0) AS on_loan,
+                          coalesce(c.on_loan, 0)::float / nullif(f.copies, 0) AS utilization
+                   FROM genre_facets f LEFT JOIN genre_circulation c ON c.genre = f.genre
+                   WHERE f.genre <> '' AND f.copies > 0
+                   ORDER BY utilization DESC NULLS LAST, f.genre'''
+            )
+            return [GenreUtilization(*row) for row in rows]
+        except Exception as e:
+            logger.error("Ошибка при получении загрузки фонда по жанрам: %s", e)
+            raise e
+
+async def run(interval: float):
+    await db_instance.create_pool()
+    try:
+        while True:
+            try:
+                folded = await fold_all()
+                if folded:
+                    logger.info("Свернуто приращений статистики: %s", folded)
+            except Exception as e:
+                logger.error("Ошибка задания статистики: %s", e)
+            await asyncio.sleep(interval)
+    finally:
+        await db_instance.close_pool()
+
+async def run_rebuild():
+    await db_instance.create_pool()
+    try:
+        await rebuild()
+    finally:
+        await db_instance.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description='Свертка статистики выдач')
+    parser.add_argument('--interval', type=float, default=30, help='секунд между свертками')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='пересчитать агрегаты по book_loans и выйти (блокирует выдачи)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=os.environ.get('LIBRARY_LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+    )
+    try:
+        asyncio.run(run_rebuild() if args.rebuild else run(args.interval))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
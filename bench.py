@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import cache
+import instrumentation
+import request
+from db import db_instance
+from models import BookSummary, BookDetail, BOOK_SUMMARY_COLUMNS, BOOK_DETAIL_COLUMNS
+from request import (authenticate_user, get_all_books, get_book, borrow_book,
+                     return_book, hash_password)
+
+OPERATIONS = ['authenticate_user', 'get_all_books', 'get_book', 'borrow_book', 'return_book']
+
+def percentile(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+async def seed(args):
+    rng = random.Random(args.random_seed)
+    pool = await db_instance.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            # TRUNCATE не вызывает триггеры, поэтому счетчики фасетов и
+            # статистики очищаются вместе с таблицами; COPY заполнит их заново
+            await conn.execute(
+                '''TRUNCATE book_loans, books, authors, users,
+                            book_facets, genre_facets, author_facets, circulation_deltas,
+                            loans_daily, book_circulation, genre_circulation
+                   RESTART IDENTITY CASCADE'''
+            )
+            await conn.copy_records_to_table(
+                'authors',
+                records=[(f'Автор {i}', f'Биография автора {i}') for i in range(1, args.authors + 1)],
+                columns=['name', 'biography']
+            )
+            # Пароль хешируется один раз: стоимость входа не зависит от пароля
+            password = hash_password('password')
+            await conn.copy_records_to_table(
+                'users',
+                records=[(f'bench_user_{i}', password, False) for i in range(1, args.users + 1)],
+                columns=['username', 'password', 'is_admin']
+            )
+            books = []
+            for i in range(1, args.books + 1):
+                quantity = rng.randint(1, 5)
+                books.append((f'Книга {i}', rng.randint(1, args.authors), f'Жанр {i % 50}',
+                              f'Описание книги {i}', quantity, quantity))
+            await conn.copy_records_to_table(
+                'books',
+                records=books,
+                columns=['title', 'author_id', 'genre', 'description',
+                         'quantity', 'available_quantity']
+            )
+            # История состоит из возвращенных выдач, поэтому остатки книг
+            # остаются согласованными
+            await conn.copy_records_to_table(
+                'book_loans',
+                records=[(rng.randint(1, args.books), rng.randint(1, args.users), True)
+                         for _ in range(args.loans)],
+                columns=['book_id', 'user_id', 'is_returned']
+            )
+            await conn.execute('UPDATE book_loans SET return_date = loan_date')
+        await conn.execute('ANALYZE')
+
+async def set_kdf_cost(n: int):
+    # Все тестовые пользователи получают хеш с заданной стоимостью; SCRYPT_N
+    # меняется тоже, чтобы вход не пересчитывал хеши по ходу замера
+    request.SCRYPT_N = n
+    password = hash_password('password')
+    pool = await db_instance.get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute('UPDATE users SET password = $1', password)
+
+async def load_ids():
+    pool = await db_instance.get_pool()
+    async with pool.acquire() as conn:
+        book_ids = [row['id'] for row in await conn.fetch('SELECT id FROM books')]
+        users = await conn.fetch('SELECT id, username FROM users')
+    if not book_ids or not users:
+        raise ValueError("База пуста, запустите бенчмарк с --seed")
+    return book_ids, [(row['id'], row['username']) for row in users]
+
+def make_workloads(book_ids, users, rng):
+    open_loans = []
+
+    async def do_authenticate_user():
+        _, username = rng.choice(users)
+        return await authenticate_user(username, 'password')
+
+    async def do_get_book():
+        return await get_book(rng.choice(book_ids))
+
+    async def do_borrow_book():
+        book_id = rng.choice(book_ids)
+        user_id, _ = rng.choice(users)
+        if await borrow_book(book_id, user_id):
+            open_loans.append((book_id, user_id))
+
+    async def do_return_book():
+        if not open_loans:
+            return False
+        book_id, user_id = open_loans.pop()
+        return await return_book(book_id, user_id)
+
+    return {
+        'authenticate_user': do_authenticate_user,
+        'get_all_books': get_all_books,
+        'get_book': do_get_book,
+        'borrow_book': do_borrow_book,
+        'return_book': do_return_book,
+    }, open_loans
+
+async def drive(operation, concurrency: int, duration: float, max_ops: int, has_work=None):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline and len(latencies) + errors < max_ops:
+            if has_work is not None and not has_work():
+                return
+            started = time.perf_counter()
+            try:
+                await operation()
+            except Exception:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'ops_per_sec': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+    }
+
+async def measure_footprint(rows: int) -> dict:
+    # Объем строк на сервере (оценка трафика) и память Python под загруженный
+    # список: прежняя выборка b.* в Record против проекций в моделях
+    variants = {
+        'records_all_columns': ('b.*, a.name AS author_name', None),
+        'book_detail': (BOOK_DETAIL_COLUMNS, BookDetail),
+        'book_summary': (BOOK_SUMMARY_COLUMNS, BookSummary),
+    }
+    footprint = {}
+    pool = await db_instance.get_pool()
+    async with pool.acquire() as conn:
+        for name, (columns, model) in variants.items():
+            query = f'''SELECT {columns} FROM books b
+                        LEFT JOIN authors a ON b.author_id = a.id
+                        ORDER BY b.id LIMIT $1'''
+            server_bytes = await conn.fetchval(
+                f'SELECT coalesce(sum(pg_column_size(t.*)), 0) FROM ({query}) t', rows
+            )
+            tracemalloc.start()
+            records = await conn.fetch(query, rows)
+            result = [model(*record) for record in records] if model else records
+            del records
+            resident_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            footprint[name] = {
+                'rows': len(result),
+                'server_bytes': server_bytes,
+                'resident_bytes': resident_bytes,
+                'resident_bytes_per_row': round(resident_bytes / len(result), 1) if result else 0.0,
+            }
+            del result
+    return footprint
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} -> {current['p95_ms']} мс")
+        if previous['ops_per_sec'] and current['ops_per_sec'] < previous['ops_per_sec'] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {previous['ops_per_sec']} -> {current['ops_per_sec']} оп/с"
+            )
+    return regressions
+
+async def run(args) -> dict:
+    try:
+        database = db_instance.settings['database']
+        if (args.seed or args.kdf_costs) and 'bench' not in database and not args.force:
+            raise ValueError(
+                f"--seed и --kdf-costs меняют данные; база {database} не похожа на тестовую "
+                "(задайте LIBRARY_DB_DATABASE=library_bench или --force)"
+            )
+        if args.seed:
+            print(f"Заполнение базы {database}...", file=sys.stderr)
+            await seed(args)
+
+        if args.no_cache:
+            for name in ('book_cache', 'author_cache', 'authors_list_cache', 'catalog_cache'):
+                getattr(cache, name).max_size = 0
+
+        book_ids, users = await load_ids()
+        workloads, open_loans = make_workloads(book_ids, users, random.Random(args.random_seed))
+        results = {}
+        for name in args.operations:
+            print(f"Замер {name}...", file=sys.stderr)
+            has_work = (lambda: bool(open_loans)) if name == 'return_book' else None
+            results[name] = await drive(workloads[name], args.concurrency, args.duration,
+                                        args.max_ops, has_work)
+        for cost in args.kdf_costs:
+            name = f'authenticate_user[n=2^{cost}]'
+            print(f"Замер {name}...", file=sys.stderr)
+            await set_kdf_cost(2 ** cost)
+            results[name] = await drive(workloads['authenticate_user'], args.concurrency,
+                                        args.duration, args.max_ops)
+        return {
+            'config': {
+                'database': database,
+                'books': len(book_ids),
+                'users': len(users),
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'pool_max_size': db_instance.settings['max_size'],
+                'cache': not args.no_cache,
+            },
+            'results': results,
+            'footprint': await measure_footprint(args.footprint) if args.footprint else None,
+            'instrumentation': instrumentation.snapshot() if instrumentation.enabled else None,
+        }
+    finally:
+        await db_instance.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Замер задержки и пропускной способности функций request.py'
+    )
+    parser.add_argument('--seed', action='store_true',
+                        help='очистить таблицы и заполнить их тестовыми данными')
+    parser.add_argument('--force', action='store_true',
+                        help='разрешить --seed и --kdf-costs для базы без "bench" в имени')
+    parser.add_argument('--authors', type=int, default=1000)
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--loans', type=int, default=100000)
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0, help='секунд на операцию')
+    parser.add_argument('--max-ops', type=int, default=1_000_000, help='предел операций на замер')
+    parser.add_argument('--kdf-costs', type=int, nargs='*', default=[],
+                        help='log2 стоимости scrypt для замера пропускной способности входа, '
+                             'например 12 14 16 (меняет пароли тестовых пользователей)')
+    parser.add_argument('--no-cache', action='store_true', help='отключить кэш request.py')
+    parser.add_argument('--footprint', type=int, default=0, metavar='ROWS',
+                        help='сравнить объем и память строк каталога: b.* против проекций')
+    parser.add_argument('--instrument', action='store_true',
+                        help='собрать гистограммы запросов и ожидания пула')
+    parser.add_argument('--output', help='файл для JSON с результатами (по умолчанию stdout)')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для поиска регрессий')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='допустимое ухудшение p95 и оп/с относительно --compare')
+    args = parser.parse_args()
+
+    if args.instrument:
+        instrumentation.enable()
+    report = asyncio.run(run(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        regressions = compare(report['results'], args.compare, args.tolerance)
+        for line in regressions:
+            print(f"Регрессия: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import secrets
+import sys
+import time
+
+from db import db_instance
+from request import borrow_book, return_book
+
+async def create_fixture(copies: int):
+    pool = await db_instance.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            suffix = secrets.token_hex(4)
+            author_id = await conn.fetchval(
+                'INSERT INTO authors (name) VALUES ($1) RETURNING id',
+                f'bench-author-{suffix}'
+            )
+            book_id = await conn.fetchval(
+                '''INSERT INTO books (title, author_id, quantity, available_quantity)
+                   VALUES ($1, $2, $3, $3) RETURNING id''',
+                f'bench-book-{suffix}', author_id, copies
+            )
+            user_id = await conn.fetchval(
+                'INSERT INTO users (username, password) VALUES ($1, $2) RETURNING id',
+                f'bench-user-{suffix}', '-'
+            )
+    return author_id, book_id, user_id
+
+async def drop_fixture(author_id: int, book_id: int, user_id: int):
+    pool = await db_instance.get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            # Выдачи замера вычитаются из статистики analytics.py: еще не
+            # свернутые приращения удаляются, а свернутые - вычитаются из агрегатов
+            await conn.execute(
+                '''WITH pending AS (
+                       DELETE FROM circulation_deltas WHERE book_id = $1
+                       RETURNING day, loans, returns
+                   ), folded AS (
+                       SELECT day, sum(loans) AS loans, sum(returns) AS returns FROM (
+                           SELECT loan_date::date AS day, 1 AS loans, 0 AS returns
+                           FROM book_loans WHERE book_id = $1
+                           UNION ALL
+                           SELECT coalesce(return_date, loan_date)::date, 0, 1
+                           FROM book_loans WHERE book_id = $1 AND is_returned
+                           UNION ALL
+                           SELECT day, -loans, -returns FROM pending
+                       ) d GROUP BY day
+                   )
+                   UPDATE loans_daily d
+                   SET loans = d.loans - f.loans, returns = d.returns - f.returns
+                   FROM folded f WHERE d.day = f.day''',
+                book_id
+            )
+            await conn.execute(
+                '''WITH removed AS (
+                       DELETE FROM book_circulation WHERE book_id = $1
+                       RETURNING genre, loans, on_loan
+                   )
+                   UPDATE genre_circulation g
+                   SET loans = g.loans - r.loans, on_loan = g.on_loan - r.on_loan
+                   FROM removed r WHERE g.genre = r.genre''',
+                book_id
+            )
+            await conn.execute('DELETE FROM book_loans WHERE book_id = $1', book_id)
+            await conn.execute('DELETE FROM books WHERE id = $1', book_id)
+            await conn.execute('DELETE FROM authors WHERE id = $1', author_id)
+            await conn.execute('DELETE FROM users WHERE id = $1', user_id)
+
+async def book_state(book_id: int):
+    pool = await db_instance.get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(
+            '''SELECT b.available_quantity,
+                      (SELECT count(*) FROM book_loans l
+                       WHERE l.book_id = b.id AND l.is_returned = FALSE) AS open_loans
+               FROM books b WHERE b.id = $1''',
+            book_id
+        )
+
+async def hammer(operation, book_id: int, user_id: int, tasks: int, attempts: int):
+    async def worker():
+        succeeded = 0
+        for _ in range(attempts):
+            if await operation(book_id, user_id):
+                succeeded += 1
+        return succeeded
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(worker() for _ in range(tasks)))
+    return sum(results), time.perf_counter() - started
+
+async def run(tasks: int, copies: int, attempts: int) -> bool:
+    author_id, book_id, user_id = await create_fixture(copies)
+    ok = True
+    try:
+        calls = tasks * attempts
+        borrowed, elapsed = await hammer(borrow_book, book_id, user_id, tasks, attempts)
+        state = await book_state(book_id)
+        print(f"Выдача: {calls} попыток из {tasks} задач за {elapsed:.3f} с "
+              f"({calls / elapsed:.0f} оп/с), успешно {borrowed} из {copies} экземпляров")
+        print(f"Остаток: {state['available_quantity']}, открытых выдач: {state['open_loans']}")
+        if state['available_quantity'] < 0 or borrowed != min(calls, copies) \
+                or state['open_loans'] != borrowed \
+                or state['available_quantity'] != copies - borrowed:
+            print("ОШИБКА: остаток не согласован с выдачами")
+            ok = False
+
+        returned, elapsed = await hammer(return_book, book_id, user_id, tasks, attempts)
+        state = await book_state(book_id)
+        print(f"Возврат: {calls} попыток за {elapsed:.3f} с "
+              f"({calls / elapsed:.0f} оп/с), возвращено {returned}")
+        print(f"Остаток: {state['available_quantity']}, открытых выдач: {state['open_loans']}")
+        if returned != borrowed or state['available_quantity'] != copies or state['open_loans'] != 0:
+            print("ОШИБКА: остаток после возврата не совпадает с количеством экземпляров")
+            ok = False
+    finally:
+        await drop_fixture(author_id, book_id, user_id)
+        await db_instance.close_pool()
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Нагрузочная проверка конкурентной выдачи и возврата одной книги'
+    )
+    parser.add_argument('--tasks', type=int, default=100, help='число параллельных задач')
+    parser.add_argument('--copies', type=int, default=10, help='число экземпляров книги')
+    parser.add_argument('--attempts', type=int, default=5, help='попыток на задачу')
+    args = parser.parse_args()
+
+    if not asyncio.run(run(args.tasks, args.copies, args.attempts)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
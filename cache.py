@@ -0,0 +1,121 @@
+import time
+from collections import OrderedDict
+
+from db import db_instance
+
+CACHE_CHANNEL = 'library_cache'
+
+class LRUCache:
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Растет при каждой инвалидации: значение, прочитанное из базы до
+        # инвалидации, не должно попасть в кэш после нее
+        self.generation = 0
+        self._data = OrderedDict()
+        self._invalidated_at = OrderedDict()
+        self._cleared_at = float('-inf')
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value, generation: int = None):
+        # generation - значение self.generation на момент начала чтения
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        self.generation += 1
+        now = time.monotonic()
+        self._invalidated_at[key] = now
+        self._invalidated_at.move_to_end(key)
+        while self._invalidated_at and (
+            len(self._invalidated_at) > self.max_size
+            or next(iter(self._invalidated_at.values())) < now - self.ttl
+        ):
+            self._invalidated_at.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.generation += 1
+        self._cleared_at = time.monotonic()
+        self._invalidated_at.clear()
+
+    def invalidated_within(self, key, seconds: float) -> bool:
+        since = time.monotonic() - seconds
+        return self._cleared_at > since or self._invalidated_at.get(key, since) > since
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+book_cache = LRUCache(max_size=4096, ttl=300)
+author_cache = LRUCache(max_size=4096, ttl=300)
+authors_list_cache = LRUCache(max_size=1, ttl=300)
+catalog_cache = LRUCache(max_size=256, ttl=30)
+
+def invalidate_book(book_id: int = None):
+    if book_id is not None:
+        book_cache.invalidate(book_id)
+    # Страницы каталога содержат остатки книг, поэтому сбрасываются целиком
+    catalog_cache.clear()
+
+def invalidate_author(author_id: int = None):
+    if author_id is not None:
+        author_cache.invalidate(author_id)
+        # Имя автора входит в карточки его книг
+        book_cache.clear()
+    authors_list_cache.clear()
+    catalog_cache.clear()
+
+def read_from_replica(cache: LRUCache, key=None) -> bool:
+    # Только что инвалидированную запись реплика может еще отдавать старой,
+    # поэтому такие чтения идут на основной сервер и не кэшируют отставание
+    return not cache.invalidated_within(key, db_instance.settings['replica_max_lag'])
+
+def handle_notification(connection, pid, channel, payload):
+    # Формат сообщения: "<таблица>:<id>", id пустой для массовых вставок
+    table, _, key = payload.partition(':')
+    key = int(key) if key else None
+    if table == 'books':
+        invalidate_book(key)
+    elif table == 'authors':
+        invalidate_author(key)
+
+def clear_all():
+    for lru in (book_cache, author_cache, authors_list_cache, catalog_cache):
+        lru.clear()
+
+async def start_invalidation_listener():
+    # Инвалидации, пропущенные за время обрыва LISTEN, неизвестны - кэш сбрасывается
+    await db_instance.add_listener(CACHE_CHANNEL, handle_notification, on_reconnect=clear_all)
+
+def stats() -> dict:
+    return {
+        'book': book_cache.stats(),
+        'author': author_cache.stats(),
+        'authors_list': authors_list_cache.stats(),
+        'catalog': catalog_cache.stats(),
+    }
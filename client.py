@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+from datetime import date, datetime
+
+import aiohttp
+
+from models import (BookSummary, BookDetail, Author, AuthorMatch, GenreFacet, AuthorFacet,
+                    DailyLoans, BookCirculation, GenreUtilization, BookEdit, EditResult,
+                    LoanSummary, OverdueLoan)
+
+logger = logging.getLogger(__name__)
+
+# Клиент HTTP-сервиса server.py. Функции повторяют сигнатуры request.py
+# и возвращают те же модели, поэтому main.py работает с любым из модулей.
+# Пользователь определяется сервисом по токену сессии, а не по user_id.
+API_URL = os.environ.get('LIBRARY_API_URL', '')
+API_TIMEOUT = float(os.environ.get('LIBRARY_API_TIMEOUT', 10))
+EVENTS_RETRY_DELAY = 5
+
+_ERRORS = {400: ValueError, 401: PermissionError, 403: PermissionError, 404: LookupError}
+
+class ApiClient:
+    def __init__(self, base_url: str, timeout: float = API_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.token = None
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Одна сессия на клиента: соединения с сервисом переиспользуются
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self._session
+
+    async def call(self, method: str, path: str, params: dict = None, body: dict = None):
+        headers = {'Authorization': f'Bearer {self.token}'} if self.token else {}
+        if params:
+            params = {key: str(value).lower() if isinstance(value, bool) else str(value)
+                      for key, value in params.items() if value is not None}
+        async with self._get_session().request(
+            method, self.base_url + path, params=params, json=body, headers=headers
+        ) as response:
+            data = await response.json()
+            if response.status >= 400:
+                error = data.get('error') if isinstance(data, dict) else None
+                raise _ERRORS.get(response.status, RuntimeError)(
+                    error or f"Ошибка сервиса: HTTP {response.status}"
+                )
+            return data
+
+    async def listen(self, path: str, callback):
+        # Переподключается, пока задачу не отменят
+        while True:
+            try:
+                async with self._get_session().ws_connect(self.base_url + path,
+                                                          heartbeat=30) as ws:
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            callback(message.data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Поток событий сервиса прерван: %s", e)
+            await asyncio.sleep(EVENTS_RETRY_DELAY)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+api = ApiClient(API_URL)
+
+def _loan(model, loan: dict):
+    for key in ('loan_date', 'due_date', 'return_date'):
+        if loan.get(key):
+            loan[key] = datetime.fromisoformat(loan[key])
+    return model(**loan)
+
+async def check_health() -> dict:
+    return await api.call('GET', '/api/health')
+
+async def add_user(username: str, password: str, is_admin: bool = False):
+    await api.call('POST', '/api/users',
+                   body={'username': username, 'password': password, 'is_admin': is_admin})
+
+async def user_exists(username: str) -> bool:
+    if not username:
+        return False
+    return (await api.call('GET', '/api/users/exists', {'username': username}))['exists']
+
+async def authenticate_user(username: str, password: str):
+    if not username or not password:
+        return None
+    try:
+        user = await api.call('POST', '/api/login',
+                              body={'username': username, 'password': password})
+    except PermissionError:
+        return None
+    api.token = user['token']
+    return user
+
+async def add_book(title: str, author_id: int, genre: str, description: str, quantity: int):
+    await api.call('POST', '/api/books', body={
+        'title': title, 'author_id': author_id, 'genre': genre,
+        'description': description, 'quantity': quantity,
+    })
+
+async def get_books_page(after_id: int = 0, limit: int = 50, filters: dict = None):
+    params = dict(filters or {}, after_id=after_id, limit=limit)
+    return [BookSummary(**book) for book in await api.call('GET', '/api/books', params)]
+
+async def get_genre_facets(author_id: int = None):
+    facets = await api.call('GET', '/api/facets/genres', {'author_id': author_id})
+    return [GenreFacet(**facet) for facet in facets]
+
+async def get_author_facets(genre: str = None, limit: int = 50):
+    facets = await api.call('GET', '/api/facets/authors', {'genre': genre, 'limit': limit})
+    return [AuthorFacet(**facet) for facet in facets]
+
+async def get_books_for_edit(after_id: int = 0, limit: int = 100, filters: dict = None):
+    params = dict(filters or {}, after_id=after_id, limit=limit)
+    return [BookEdit(**book) for book in await api.call('GET', '/api/books/edit', params)]
+
+async def update_books(edits: list) -> list:
+    results = await api.call('POST', '/api/books/edit', body={'edits': edits})
+    return [EditResult(**result) for result in results]
+
+async def search_books(query: str, limit: int = 50):
+    books = await api.call('GET', '/api/books/search', {'q': query, 'limit': limit})
+    return [BookSummary(**book) for book in books]
+
+async def get_book(book_id: int):
+    try:
+        return BookDetail(**await api.call('GET', f'/api/books/{book_id}'))
+    except LookupError:
+        return None
+
+async def add_author(name: str, biography: str = None):
+    await api.call('POST', '/api/authors', body={'name': name, 'biography': biography})
+
+async def lookup_authors(query: str, limit: int = 10):
+    authors = await api.call('GET', '/api/authors/lookup', {'q': query, 'limit': limit})
+    return [AuthorMatch(**author) for author in authors]
+
+async def get_author(author_id: int):
+    try:
+        return Author(**await api.call('GET', f'/api/authors/{author_id}'))
+    except LookupError:
+        return None
+
+async def borrow_book(book_id: int, user_id: int = None) -> bool:
+    return (await api.call('POST', f'/api/books/{book_id}/borrow'))['ok']
+
+async def return_book(book_id: int, user_id: int = None) -> bool:
+    return (await api.call('POST', f'/api/books/{book_id}/return'))['ok']
+
+async def borrow_books(user_id: int, book_ids: list) -> list:
+    results = await api.call('POST', '/api/books/borrow', body={'book_ids': book_ids})
+    return [tuple(result) for result in results]
+
+async def return_books(user_id: int, book_ids: list) -> list:
+    results = await api.call('POST', '/api/books/return', body={'book_ids': book_ids})
+    return [tuple(result) for result in results]
+
+async def return_loan(loan_id: int, user_id: int = None) -> bool:
+    return (await api.call('POST', f'/api/loans/{loan_id}/return'))['ok']
+
+async def get_user_loans(user_id: int, before_id: int = None, limit: int = 50,
+                         open_only: bool = False):
+    loans = await api.call('GET', '/api/loans',
+                           {'before_id': before_id, 'limit': limit, 'open_only': open_only})
+    return [_loan(LoanSummary, loan) for loan in loans]
+
+async def get_overdue_loans(after_due=None, after_id: int = 0, limit: int = 50):
+    loans = await api.call('GET', '/api/loans/overdue', {
+        'after_due': after_due.isoformat() if after_due else None,
+        'after_id': after_id, 'limit': limit,
+    })
+    return [_loan(OverdueLoan, loan) for loan in loans]
+
+async def reserve_book(book_id: int, user_id: int = None):
+    return await api.call('POST', f'/api/books/{book_id}/reserve')
+
+async def get_catalog_changes(table: str, since: int, after_id: int = 0, limit: int = 5000):
+    return await api.call('GET', '/api/catalog/changes',
+                          {'table': table, 'since': since, 'after_id': after_id, 'limit': limit})
+
+async def loans_per_day(days: int = 30):
+    rows = await api.call('GET', '/api/stats/daily', {'days': days})
+    return [DailyLoans(**dict(row, day=date.fromisoformat(row['day']))) for row in rows]
+
+async def top_books(limit: int = 10):
+    return [BookCirculation(**row) for row in
+            await api.call('GET', '/api/stats/top-books', {'limit': limit})]
+
+async def genre_utilization():
+    return [GenreUtilization(**row) for row in await api.call('GET', '/api/stats/genres')]
+
+async def listen_availability(callback):
+    # callback(book_id, available_quantity) на каждое изменение наличия
+    def on_message(payload):
+        book_id, available_quantity = map(int, payload.split(':'))
+        callback(book_id, available_quantity)
+    await api.listen('/api/events', on_message)
+
+async def close():
+    await api.close()
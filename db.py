@@ -1,6 +1,15 @@
 import asyncpg
 import asyncio
-import sys
+import configparser
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+import instrumentation
+import migrations
+
+logger = logging.getLogger(__name__)
 
 DB_USER = 'postgres'
 DB_PASSWORD = 'postgres'
@@ -8,121 +17,257 @@ DB_NAME = 'library_db'
 DB_HOST = '127.0.0.1'
 DB_PORT = '5432'
 
+# Пауза перед переподключением LISTEN растет вдвое до максимума, секунды
+LISTEN_RETRY_DELAY = 1
+LISTEN_RETRY_MAX_DELAY = 30
+
+# Значения по умолчанию; переопределяются секцией [database] файла из
+# LIBRARY_DB_CONFIG и переменными окружения LIBRARY_DB_<ПАРАМЕТР>
+DEFAULT_SETTINGS = {
+    'user': DB_USER,
+    'password': DB_PASSWORD,
+    'database': DB_NAME,
+    'host': DB_HOST,
+    'port': DB_PORT,
+    'min_size': 2,
+    'max_size': 10,
+    'statement_cache_size': 100,
+    'max_inactive_connection_lifetime': 300.0,
+    'connect_timeout': 60.0,
+    'command_timeout': 60.0,
+    # Серверные таймауты в миллисекундах, 0 - без ограничения
+    'statement_timeout': 0,
+    'lock_timeout': 0,
+    'idle_in_transaction_session_timeout': 0,
+    # Сколько секунд после инвалидации кэша запись читается с основного
+    # сервера, а не с реплики: реплика может еще не применить изменение
+    'replica_max_lag': 5.0,
+}
+
+SERVER_TIMEOUTS = ('statement_timeout', 'lock_timeout', 'idle_in_transaction_session_timeout')
+
+def _apply_overrides(settings: dict, overrides) -> dict:
+    for key, value in overrides.items():
+        if key in DEFAULT_SETTINGS and value not in (None, ''):
+            settings[key] = type(DEFAULT_SETTINGS[key])(value)
+    return settings
+
+def load_settings(config_path: str = None) -> dict:
+    config_path = config_path or os.environ.get('LIBRARY_DB_CONFIG')
+    parser = configparser.ConfigParser()
+    if config_path:
+        if not parser.read(config_path, encoding='utf-8'):
+            raise FileNotFoundError(f"Файл настроек базы данных не найден: {config_path}")
+    
+    settings = dict(DEFAULT_SETTINGS)
+    if parser.has_section('database'):
+        _apply_overrides(settings, parser['database'])
+    _apply_overrides(settings, {
+        key: os.environ.get(f'LIBRARY_DB_{key.upper()}') for key in DEFAULT_SETTINGS
+    })
+    
+    # Реплика для чтения включается, если задан ее хост; остальные параметры
+    # наследуются от основного сервера
+    replica = dict(settings)
+    if parser.has_section('replica'):
+        _apply_overrides(replica, parser['replica'])
+    _apply_overrides(replica, {
+        key: os.environ.get(f'LIBRARY_DB_REPLICA_{key.upper()}') for key in DEFAULT_SETTINGS
+    })
+    has_replica = (
+        (parser.has_section('replica') and parser['replica'].get('host'))
+        or os.environ.get('LIBRARY_DB_REPLICA_HOST')
+    )
+    settings['replica'] = replica if has_replica else None
+    return settings
+
+def connect_kwargs(settings: dict, database: str = None) -> dict:
+    server_settings = {'application_name': 'library'}
+    for name in SERVER_TIMEOUTS:
+        if settings[name]:
+            server_settings[name] = str(settings[name])
+    return {
+        'user': settings['user'],
+        'password': settings['password'],
+        'database': database or settings['database'],
+        'host': settings['host'],
+        'port': settings['port'],
+        'timeout': settings['connect_timeout'],
+        'command_timeout': settings['command_timeout'],
+        'statement_cache_size': settings['statement_cache_size'],
+        # Таймауты уходят в стартовом пакете соединения, без отдельных SET
+        'server_settings': server_settings,
+    }
+
+def pool_kwargs(settings: dict) -> dict:
+    kwargs = connect_kwargs(settings)
+    kwargs.update(
+        min_size=settings['min_size'],
+        max_size=settings['max_size'],
+        max_inactive_connection_lifetime=settings['max_inactive_connection_lifetime'],
+    )
+    if instrumentation.enabled:
+        kwargs['init'] = instrumentation.setup_connection
+    return kwargs
+
 class Database:
-    def __init__(self):
+    def __init__(self, settings: dict = None):
+        self.settings = settings or load_settings()
         self._db_pool = None
+        self._read_pool = None
+        self._listen_conn = None
+        # Подписки восстанавливаются после обрыва соединения LISTEN
+        self._listeners = []
+        self._reconnect_callbacks = []
+        self._reconnect_task = None
         self._initialized = False
+        self._pool_lock = asyncio.Lock()
+        # Длительности этапов запуска в миллисекундах: pool_ms, schema_ms
+        self.timings = {}
 
     async def create_pool(self):
-        if self._db_pool is None:
+        # Пул может запрашиваться одновременно фоновым прогревом и экранами
+        async with self._pool_lock:
+            if self._db_pool is None:
+                await self._create_pool()
+
+    async def _create_pool(self):
+        settings = self.settings
+        try:
+            logger.info("Подключение к базе данных: %s:%s", settings['host'], settings['port'])
+            started = time.perf_counter()
             try:
-                print(f"Подключение к базе данных: {DB_HOST}:{DB_PORT}")
-                self._db_pool = await asyncpg.create_pool(
-                    user=DB_USER,
-                    password=DB_PASSWORD,
-                    database=DB_NAME,
-                    host=DB_HOST,
-                    port=DB_PORT,
-                    min_size=2,
-                    max_size=10,
-                    command_timeout=60
-                )
-                if not self._initialized:
-                    await self.initialize_tables()
-                    self._initialized = True
+                self._db_pool = await asyncpg.create_pool(**pool_kwargs(settings))
             except asyncpg.InvalidCatalogNameError:
-                print(f"База данных {DB_NAME} не существует, создаем...")
+                logger.info("База данных %s не существует, создаем...", settings['database'])
                 try:
-                    sys_conn = await asyncpg.connect(
-                        user=DB_USER,
-                        password=DB_PASSWORD,
-                        database='postgres',
-                        host=DB_HOST,
-                        port=DB_PORT,
-                        command_timeout=60
-                    )
-                    await sys_conn.execute(f'CREATE DATABASE {DB_NAME}')
+                    sys_conn = await asyncpg.connect(**connect_kwargs(settings, database='postgres'))
+                    await sys_conn.execute(f'CREATE DATABASE {settings["database"]}')
                     await sys_conn.close()
                     
-                    self._db_pool = await asyncpg.create_pool(
-                        user=DB_USER,
-                        password=DB_PASSWORD,
-                        database=DB_NAME,
-                        host=DB_HOST,
-                        port=DB_PORT,
-                        min_size=2,
-                        max_size=10,
-                        command_timeout=60
-                    )
-                    await self.initialize_tables()
-                    self._initialized = True
+                    self._db_pool = await asyncpg.create_pool(**pool_kwargs(settings))
                 except Exception as e:
-                    print(f"Ошибка при создании базы данных: {e}")
+                    logger.error("Ошибка при создании базы данных: %s", e)
                     raise e
+            self.timings['pool_ms'] = (time.perf_counter() - started) * 1000
+            
+            if not self._initialized:
+                await self.initialize_tables()
+                self._initialized = True
+        except Exception as e:
+            logger.error("Ошибка при подключении к базе данных: %s", e)
+            logger.error("Проверьте, что PostgreSQL запущен и доступен по адресу %s:%s",
+                         settings['host'], settings['port'])
+            logger.error("Проверьте правильность имени пользователя (%s) и пароля", settings['user'])
+            # Недоинициализированный пул не отдаем: следующая попытка начнет заново
+            if self._db_pool is not None:
+                await self._db_pool.close()
+                self._db_pool = None
+            raise e
+
+    async def create_read_pool(self):
+        replica = self.settings['replica']
+        if self._read_pool is None and replica is not None:
+            try:
+                logger.info("Подключение к реплике: %s:%s", replica['host'], replica['port'])
+                self._read_pool = await asyncpg.create_pool(**pool_kwargs(replica))
             except Exception as e:
-                print(f"Ошибка при подключении к базе данных: {e}")
-                print(f"Проверьте, что PostgreSQL запущен и доступен по адресу {DB_HOST}:{DB_PORT}")
-                print(f"Проверьте правильность имени пользователя ({DB_USER}) и пароля")
+                logger.error("Ошибка при подключении к реплике: %s", e)
                 raise e
 
     async def initialize_tables(self):
-        print("Начало инициализации таблиц")
+        logger.info("Проверка схемы базы данных")
+        started = time.perf_counter()
         async with self._db_pool.acquire() as conn:
-            print("Создание таблицы users...")
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    password VARCHAR(100) NOT NULL,
-                    is_admin BOOLEAN DEFAULT FALSE
-                )
-            ''')
-            print("Таблица users создана")
-            
-            print("Создание таблицы authors...")
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS authors (
-                    id SERIAL PRIMARY KEY,
-                    name VARCHAR(100) NOT NULL,
-                    biography TEXT
-                )
-            ''')
-            print("Таблица authors создана")
-            
-            print("Создание таблицы books...")
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS books (
-                    id SERIAL PRIMARY KEY,
-                    title VARCHAR(200) NOT NULL,
-                    author_id INTEGER REFERENCES authors(id),
-                    genre VARCHAR(50),
-                    description TEXT,
-                    quantity INTEGER DEFAULT 1,
-                    available_quantity INTEGER DEFAULT 1
-                )
-            ''')
-            print("Таблица books создана")
-            
-            print("Создание таблицы book_loans...")
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS book_loans (
-                    id SERIAL PRIMARY KEY,
-                    book_id INTEGER REFERENCES books(id),
-                    user_id INTEGER REFERENCES users(id),
-                    loan_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    return_date TIMESTAMP,
-                    is_returned BOOLEAN DEFAULT FALSE
-                )
-            ''')
-            print("Таблица book_loans создана")
-            print("Все таблицы успешно созданы")
+            await migrations.migrate(conn)
+        self.timings['schema_ms'] = (time.perf_counter() - started) * 1000
 
     async def get_pool(self):
         if self._db_pool is None:
             await self.create_pool()
         return self._db_pool
 
+    async def get_read_pool(self):
+        # Без настроенной реплики чтение идет в основной пул
+        if self.settings['replica'] is None:
+            return await self.get_pool()
+        if self._read_pool is None:
+            await self.create_read_pool()
+        return self._read_pool
+
+    @asynccontextmanager
+    async def acquire(self, readonly: bool = False):
+        pool = await (self.get_read_pool() if readonly else self.get_pool())
+        if not instrumentation.enabled:
+            async with pool.acquire() as conn:
+                yield conn
+            return
+        
+        started = time.perf_counter()
+        async with pool.acquire() as conn:
+            instrumentation.observe_pool_wait((time.perf_counter() - started) * 1000)
+            yield conn
+
+    async def add_listener(self, channel, callback, on_reconnect=None):
+        # Все подписки LISTEN делят одно выделенное соединение вне пула;
+        # реплики LISTEN не поддерживают, поэтому подключаемся к основному серверу.
+        # on_reconnect() вызывается после восстановления оборванного соединения:
+        # уведомления, отправленные без него, потеряны
+        if self._listen_conn is None or self._listen_conn.is_closed():
+            await self._connect_listener()
+        await self._listen_conn.add_listener(channel, callback)
+        self._listeners.append((channel, callback))
+        if on_reconnect is not None:
+            self._reconnect_callbacks.append(on_reconnect)
+
+    async def _connect_listener(self):
+        conn = await asyncpg.connect(**connect_kwargs(self.settings))
+        conn.add_termination_listener(self._on_listen_terminated)
+        self._listen_conn = conn
+
+    def _on_listen_terminated(self, connection):
+        # Соединение, закрытое в close_pool, уже не текущее
+        if connection is not self._listen_conn:
+            return
+        logger.error("Соединение LISTEN разорвано, переподключение")
+        self._listen_conn = None
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.create_task(self._reconnect_listener())
+
+    async def _reconnect_listener(self):
+        delay = LISTEN_RETRY_DELAY
+        while True:
+            try:
+                await self._connect_listener()
+                for channel, callback in self._listeners:
+                    await self._listen_conn.add_listener(channel, callback)
+                break
+            except Exception as e:
+                logger.error("Ошибка переподключения LISTEN: %s", e)
+                conn, self._listen_conn = self._listen_conn, None
+                if conn is not None:
+                    conn.terminate()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LISTEN_RETRY_MAX_DELAY)
+        logger.info("Соединение LISTEN восстановлено, каналов: %s", len(self._listeners))
+        for callback in self._reconnect_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Ошибка обработчика переподключения LISTEN: %s", e)
+
     async def close_pool(self):
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        self._listeners = []
+        self._reconnect_callbacks = []
+        if self._listen_conn:
+            conn, self._listen_conn = self._listen_conn, None
+            await conn.close()
+        if self._read_pool:
+            await self._read_pool.close()
+            self._read_pool = None
         if self._db_pool:
             await self._db_pool.close()
             self._db_pool = None
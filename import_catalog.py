@@ -0,0 +1,45 @@
+import argparse
+import asyncio
+import sys
+
+from db import db_instance
+from request import import_catalog
+
+def print_progress(table: str, rows: int, rows_per_sec: float):
+    print(f"{table}: загружено {rows} строк ({rows_per_sec:.0f} строк/с)")
+
+async def run(args) -> dict:
+    try:
+        return await import_catalog(
+            authors_path=args.authors,
+            books_path=args.books,
+            batch_size=args.batch_size,
+            progress=print_progress
+        )
+    finally:
+        await db_instance.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Массовая загрузка авторов и книг из CSV или JSONL через COPY'
+    )
+    parser.add_argument('--authors', help='файл авторов: name, biography')
+    parser.add_argument('--books',
+                        help='файл книг: title, author или author_id, genre, description, quantity')
+    parser.add_argument('--batch-size', type=int, default=10000, help='строк в одном пакете COPY')
+    args = parser.parse_args()
+
+    if not args.authors and not args.books:
+        parser.error('укажите --authors и/или --books')
+
+    try:
+        stats = asyncio.run(run(args))
+    except Exception as e:
+        print(f"Импорт прерван: {e}")
+        sys.exit(1)
+
+    print(f"Авторов: {stats['authors']}, книг: {stats['books']}, "
+          f"за {stats['seconds']:.1f} с ({stats['rows_per_sec']:.0f} строк/с)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import bisect
+import logging
+import os
+
+logger = logging.getLogger('library.db')
+
+# Инструментирование включается до создания пулов: обработчик запросов
+# вешается на соединения при их открытии. Выключенное, оно не добавляет
+# к запросам ничего, кроме одной проверки флага при выдаче соединения.
+enabled = os.environ.get('LIBRARY_INSTRUMENT', '') not in ('', '0')
+slow_query_ms = float(os.environ.get('LIBRARY_SLOW_QUERY_MS', '200'))
+
+_trace_hook = None
+
+class Histogram:
+    BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, value_ms: float):
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, value_ms)] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        if value_ms > self.max_ms:
+            self.max_ms = value_ms
+
+    def percentile(self, fraction: float) -> float:
+        # Верхняя граница корзины, в которую попадает перцентиль
+        threshold = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= threshold and count:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ms / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max_ms,
+        }
+
+query_latency = {}
+pool_wait = Histogram()
+
+def enable(slow_ms: float = None):
+    global enabled, slow_query_ms
+    enabled = True
+    if slow_ms is not None:
+        slow_query_ms = slow_ms
+
+def set_trace_hook(hook):
+    # hook(query, args_count, elapsed_ms, exception) вызывается на каждый запрос
+    global _trace_hook
+    _trace_hook = hook
+
+def observe_pool_wait(elapsed_ms: float):
+    pool_wait.observe(elapsed_ms)
+    if elapsed_ms >= slow_query_ms:
+        logger.warning("Долгое ожидание соединения из пула: %.1f мс", elapsed_ms)
+
+def on_query(record):
+    elapsed_ms = record.elapsed * 1000
+    histogram = query_latency.get(record.query)
+    if histogram is None:
+        histogram = query_latency[record.query] = Histogram()
+    histogram.observe(elapsed_ms)
+
+    args_count = len(record.args) if record.args else 0
+    if record.exception is not None:
+        logger.warning("Запрос завершился ошибкой за %.1f мс (параметров: %d): %s: %s",
+                       elapsed_ms, args_count, record.exception, record.query)
+    elif elapsed_ms >= slow_query_ms:
+        logger.warning("Медленный запрос: %.1f мс (параметров: %d): %s",
+                       elapsed_ms, args_count, record.query)
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Запрос: %.1f мс (параметров: %d): %s", elapsed_ms, args_count, record.query)
+
+    if _trace_hook is not None:
+        _trace_hook(record.query, args_count, elapsed_ms, record.exception)
+
+async def setup_connection(conn):
+    conn.add_query_logger(on_query)
+
+def snapshot() -> dict:
+    return {
+        'pool_wait': pool_wait.snapshot(),
+        'queries': {query: histogram.snapshot() for query, histogram in query_latency.items()},
+    }
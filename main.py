@@ -1,44 +1,76 @@
+import time
+
+# Точка отсчета профиля запуска - до импорта Kivy и модулей приложения
+STARTED_AT = time.perf_counter()
+
 from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.gridlayout import GridLayout
-from kivy.uix.label import Label
 from kivy.uix.button import Button
-from kivy.uix.textinput import TextInput
-from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.properties import BooleanProperty, NumericProperty, ObjectProperty, StringProperty
 from kivy.clock import Clock
 import asyncio
-import sys
+import logging
+import os
+from collections import deque
 
 from db import db_instance
-from request import (add_user, user_exists, authenticate_user, add_book, 
-                    get_all_books, get_book, add_author, get_all_authors,
-                    get_author, borrow_book, return_book)
+from cache import start_invalidation_listener
+from scheduler import TaskScheduler
+from snapshot import CatalogSnapshot
+from request import AVAILABILITY_CHANNEL
+
+# С LIBRARY_API_URL приложение работает через HTTP-сервис server.py
+# и не открывает собственный пул соединений с Postgres
+API_URL = os.environ.get('LIBRARY_API_URL', '')
+if API_URL:
+    import client
+    from client import (add_user, user_exists, authenticate_user, add_book,
+                        get_books_page, search_books, get_book, add_author,
+                        borrow_book, return_loan, get_user_loans, get_overdue_loans,
+                        reserve_book, lookup_authors, get_catalog_changes,
+                        get_genre_facets, get_author_facets,
+                        loans_per_day, top_books, genre_utilization,
+                        get_books_for_edit, update_books)
+else:
+    from request import (add_user, user_exists, authenticate_user, add_book,
+                         get_books_page, search_books, get_book, add_author,
+                         borrow_book, return_loan, get_user_loans, get_overdue_loans,
+                         reserve_book, lookup_authors, get_catalog_changes,
+                         get_genre_facets, get_author_facets, get_books_for_edit,
+                         update_books)
+    from analytics import loans_per_day, top_books, genre_utilization
+
+IMPORTS_DONE_AT = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+PROFILE_STARTUP = os.environ.get('LIBRARY_PROFILE_STARTUP', '') not in ('', '0')
 
 class LoginScreen(Screen):
     def login(self):
-        print("Начало входа")
+        logger.debug("Начало входа")
         app = App.get_running_app()
         username = self.ids.username_input.text
         password = self.ids.password_input.text
         
         async def do_login():
             try:
-                print(f"Попытка входа для пользователя: {username}")
+                logger.debug("Попытка входа для пользователя: %s", username)
                 user = await authenticate_user(username, password)
                 if user:
-                    print("Вход успешен")
+                    logger.info("Вход пользователя %s успешен", username)
                     app.current_user = user
-                    app.loop.call_soon_threadsafe(self.switch_to_main)
+                    self.switch_to_main()
                 else:
-                    print("Неверные учетные данные")
-                    app.loop.call_soon_threadsafe(lambda: self.show_error('Неверный логин или пароль'))
+                    logger.info("Неверные учетные данные для пользователя %s", username)
+                    self.show_error('Неверный логин или пароль')
             except Exception as e:
-                print(f"Ошибка при входе: {str(e)}")
-                app.loop.call_soon_threadsafe(lambda: self.show_error(str(e)))
+                logger.error("Ошибка при входе: %s", e)
+                self.show_error(str(e))
 
-        future = app.loop.create_task(do_login())
-        future.add_done_callback(lambda f: print("Процесс входа завершен"))
+        future = app.spawn(do_login(), 'login')
 
     def switch_to_main(self):
         if App.get_running_app().current_user['is_admin']:
@@ -46,139 +78,551 @@ class LoginScreen(Screen):
         else:
             self.manager.current = 'library_main'
 
+    def browse_offline(self):
+        # Каталог из локального снимка доступен без входа и без базы, только для чтения
+        App.get_running_app().current_user = None
+        self.manager.current = 'library_main'
+
     def show_error(self, error_msg):
         self.ids.error_label.text = error_msg
 
 class RegistrationScreen(Screen):
     def register(self):
-        print("Начало регистрации")
+        logger.debug("Начало регистрации")
         app = App.get_running_app()
         username = self.ids.username_input.text
         password = self.ids.password_input.text
         is_admin = self.ids.admin_checkbox.active
         
-        print(f"Данные для регистрации: username={username}, is_admin={is_admin}")
+        logger.debug("Данные для регистрации: username=%s, is_admin=%s", username, is_admin)
         
         async def register_user():
-            print("Начало асинхронной регистрации")
+            logger.debug("Начало асинхронной регистрации")
             try:
                 if not username or not password:
-                    print("Пустые поля")
-                    app.loop.call_soon_threadsafe(lambda: self.show_error('Заполните все поля'))
+                    logger.debug("Пустые поля")
+                    self.show_error('Заполните все поля')
                     return
                 
                 exists = await user_exists(username)
-                print(f"Проверка существ��вания пользователя: {exists}")
+                logger.debug("Проверка существования пользователя: %s", exists)
                 
                 if exists:
-                    print("Пользователь уже существует")
-                    app.loop.call_soon_threadsafe(lambda: self.show_error('Пользователь с таким логином уже существует!'))
+                    logger.debug("Пользователь уже существует")
+                    self.show_error('Пользователь с таким логином уже существует!')
                 else:
-                    print("Добавление нового пользователя")
+                    logger.debug("Добавление нового пользователя")
                     await add_user(username, password, is_admin)
-                    print("Пользователь добавлен успешно")
+                    logger.info("Пользователь %s зарегистрирован", username)
                     # После регистрации авторизуем пользователя
                     user = await authenticate_user(username, password)
                     if user:
-                        print("Автоматическая авторизация успешна")
+                        logger.debug("Автоматическая авторизация успешна")
                         app.current_user = user
-                        app.loop.call_soon_threadsafe(self.switch_to_main)
+                        self.switch_to_main()
                     else:
-                        print("Ошибка автоматической авторизации")
+                        logger.error("Ошибка автоматической авторизации")
                         raise ValueError("Ошибка автоматической авторизации")
             except Exception as e:
-                print(f"Ошибка при регис��рации: {str(e)}")
+                logger.error("Ошибка при регистрации: %s", e)
                 error_msg = str(e)
-                app.loop.call_soon_threadsafe(lambda: self.show_error(error_msg))
+                self.show_error(error_msg)
 
         try:
-            print("Создание задачи регистрации")
-            future = app.loop.create_task(register_user())
-            print("Задача регистрации создана")
+            logger.debug("Создание задачи регистрации")
+            future = app.spawn(register_user(), 'register')
+            logger.debug("Задача регистрации создана")
         except Exception as e:
-            print(f"Ошибка при создании задачи: {str(e)}")
+            logger.error("Ошибка при создании задачи: %s", e)
             self.show_error(f"Системная ошибка: {str(e)}")
 
     def switch_to_main(self):
-        print("Переключение на главный экран")
+        logger.debug("Переключение на главный экран")
         if App.get_running_app().current_user['is_admin']:
-            print("Переход на панель администратора")
+            logger.debug("Переход на панель администратора")
             self.manager.current = 'admin_panel'
         else:
-            print("Переход на экран библиотеки")
+            logger.debug("Переход на экран библиотеки")
             self.manager.current = 'library_main'
 
     def show_error(self, error_msg):
-        print(f"Отображение ошибки: {error_msg}")
+        logger.debug("Отображение ошибки: %s", error_msg)
         self.ids.error_label.text = f'Ошибка: {error_msg}'
 
+class BookRow(BoxLayout):
+    book_id = NumericProperty(0)
+    title = StringProperty('')
+    author_name = StringProperty('')
+    available_quantity = NumericProperty(0)
+
+    def show_details(self):
+        app = App.get_running_app()
+        app.book_id = self.book_id
+        app.root.current = 'book_details'
+
 class LibraryMainScreen(Screen):
+    PAGE_SIZE = 50
+    # Догружаем следующую страницу, когда до конца списка осталось меньше 20%
+    LOAD_THRESHOLD = 0.2
+    SEARCH_DELAY = 0.3
+    SEARCH_LIMIT = 100
+    # Как в request.search_books: более короткий запрос не ищется
+    SEARCH_MIN_LENGTH = 3
+    AUTHOR_FACETS_LIMIT = 50
+    ALL_GENRES = 'Все жанры'
+    ALL_AUTHORS = 'Все авторы'
+
+    _search_event = None
+    # Фильтры каталога: genre, author_id, available_only
+    filters = {}
+    # Подпись пункта фильтра -> значение фильтра
+    _genre_values = {}
+    _author_values = {}
+    # book_id -> позиция строки в books_list.data для точечных обновлений
+    _row_index = {}
+
     def on_enter(self):
+        self.load_facets()
+        if self.ids.search_input.text.strip():
+            self.search(self.ids.search_input.text)
+        else:
+            self.reset_catalog()
+
+    def load_facets(self):
+        # Счетчики в подписях показывают, сколько книг останется после выбора
+        # пункта при остальных фильтрах; с отметкой наличия - только доступные
         app = App.get_running_app()
-        async def load_books():
+        filters = dict(self.filters)
+        count = 'available' if filters.get('available_only') else 'total'
+        async def do_load_genres():
+            try:
+                facets = await app.tasks.shared(
+                    ('genre_facets', filters.get('author_id')),
+                    lambda: get_genre_facets(filters.get('author_id'))
+                )
+                values = {self.ALL_GENRES: None}
+                values.update(
+                    (f'{facet.genre} ({getattr(facet, count)})', facet.genre) for facet in facets
+                )
+                # Подписи прежних списков остаются известны: выбор мог
+                # случиться, пока список обновлялся
+                self._genre_values = {**self._genre_values, **values}
+                self.ids.genre_spinner.values = list(values)
+            except Exception as e:
+                logger.error("Ошибка загрузки фасетов по жанрам: %s", e)
+        async def do_load_authors():
             try:
-                books = await get_all_books()
-                self.ids.books_grid.clear_widgets()
-                for book in books:
-                    book_widget = BoxLayout(orientation='vertical', size_hint_y=None, height=100)
-                    book_widget.add_widget(Label(text=f'Название: {book["title"]}'))
-                    book_widget.add_widget(Label(text=f'Автор: {book["author_name"]}'))
-                    book_widget.add_widget(Label(text=f'Доступно: {book["available_quantity"]}'))
-                    details_btn = Button(text='Подробнее')
-                    details_btn.book_id = book['id']
-                    details_btn.bind(on_press=self.show_book_details)
-                    book_widget.add_widget(details_btn)
-                    self.ids.books_grid.add_widget(book_widget)
+                facets = await app.tasks.shared(
+                    ('author_facets', filters.get('genre'), self.AUTHOR_FACETS_LIMIT),
+                    lambda: get_author_facets(filters.get('genre'), self.AUTHOR_FACETS_LIMIT)
+                )
+                values = {self.ALL_AUTHORS: None}
+                values.update(
+                    (f'{facet.name} ({getattr(facet, count)})', facet.author_id) for facet in facets
+                )
+                self._author_values = {**self._author_values, **values}
+                self.ids.author_spinner.values = list(values)
             except Exception as e:
-                print(f'Ошибка загрузки книг: {str(e)}')
+                logger.error("Ошибка загрузки фасетов по авторам: %s", e)
         
-        future = app.loop.create_task(load_books())
+        app.tasks.submit(self, 'genre_facets', do_load_genres, 'load_genre_facets')
+        app.tasks.submit(self, 'author_facets', do_load_authors, 'load_author_facets')
+
+    def on_genre_selected(self, text):
+        self.set_filter('genre', self._genre_values.get(text))
+
+    def on_author_selected(self, text):
+        self.set_filter('author_id', self._author_values.get(text))
+
+    def on_available_only(self, active):
+        self.set_filter('available_only', active or None)
+
+    def set_filter(self, name, value):
+        filters = dict(self.filters)
+        if value is None:
+            filters.pop(name, None)
+        else:
+            filters[name] = value
+        if filters == self.filters:
+            return
+        self.filters = filters
+        self.load_facets()
+        # Фильтры применяются к каталогу: очистка строки поиска сама вернет
+        # к нему список после задержки поиска
+        if self.ids.search_input.text:
+            self.ids.search_input.text = ''
+        else:
+            self.reset_catalog()
+
+    def on_leave(self):
+        if self._search_event is not None:
+            self._search_event.cancel()
+        App.get_running_app().tasks.cancel(self)
+
+    def reset_catalog(self):
+        self.show_rows([])
+        self.ids.books_list.scroll_y = 1
+        self._last_id = 0
+        self._exhausted = False
+        self._loading = False
+        self.load_next_page()
+
+    def on_books_scroll(self, scroll_y):
+        if scroll_y <= self.LOAD_THRESHOLD:
+            self.load_next_page()
+
+    def on_search_text(self, text):
+        if self._search_event is not None:
+            self._search_event.cancel()
+        self._search_event = Clock.schedule_once(lambda dt: self.search(text), self.SEARCH_DELAY)
+
+    def search(self, text):
+        if len(text.strip()) < self.SEARCH_MIN_LENGTH:
+            self.reset_catalog()
+            return
+        
+        # В режиме поиска постраничная догрузка каталога отключена
+        self._exhausted = True
+        app = App.get_running_app()
+        async def do_search():
+            try:
+                books = await app.tasks.shared(
+                    ('search_books', text, self.SEARCH_LIMIT),
+                    lambda: search_books(text, self.SEARCH_LIMIT)
+                )
+                self.show_rows([self.book_row(book) for book in books])
+                self.ids.books_list.scroll_y = 1
+            except Exception as e:
+                logger.error("Ошибка поиска книг: %s", e)
+        
+        # Поиск и страницы каталога занимают один слот: новый запрос отменяет
+        # устаревший, и его ответ уже не попадет в список
+        app.tasks.submit(self, 'books', do_search, 'search_books')
+
+    def load_next_page(self):
+        if self._loading or self._exhausted:
+            return
+        self._loading = True
+        app = App.get_running_app()
+        async def load_page():
+            try:
+                after_id = self._last_id
+                filters = dict(self.filters) or None
+                # Синхронизированный снимок читается с локального диска
+                if app.snapshot.ready:
+                    books = await app.snapshot.get_books_page(after_id, self.PAGE_SIZE, filters)
+                else:
+                    books = await app.tasks.shared(
+                        ('books_page', after_id, self.PAGE_SIZE,
+                         tuple(sorted(filters.items())) if filters else None),
+                        lambda: get_books_page(after_id, self.PAGE_SIZE, filters)
+                    )
+                if len(books) < self.PAGE_SIZE:
+                    self._exhausted = True
+                if books:
+                    self._last_id = books[-1].id
+                    self.append_rows([self.book_row(book) for book in books])
+            except Exception as e:
+                logger.error("Ошибка загрузки книг: %s", e)
+            finally:
+                self._loading = False
+        
+        app.tasks.submit(self, 'books', load_page, 'load_books_page')
+
+    def show_rows(self, rows):
+        self._row_index = {row['book_id']: i for i, row in enumerate(rows)}
+        self.ids.books_list.data = rows
+
+    def append_rows(self, rows):
+        data = self.ids.books_list.data
+        for i, row in enumerate(rows, start=len(data)):
+            self._row_index[row['book_id']] = i
+        data.extend(rows)
+
+    def on_availability_changed(self, book_id, available_quantity):
+        # Замена одного элемента data перерисовывает только эту строку
+        index = self._row_index.get(book_id)
+        if index is not None:
+            data = self.ids.books_list.data
+            data[index] = dict(data[index], available_quantity=available_quantity)
 
-    def show_book_details(self, instance):
-        App.get_running_app().book_id = instance.book_id
-        self.manager.current = 'book_details'
+    @staticmethod
+    def book_row(book):
+        return {
+            'book_id': book.id,
+            'title': book.title,
+            'author_name': book.author_name or '',
+            'available_quantity': book.available_quantity,
+        }
 
 class BookDetailsScreen(Screen):
     def on_enter(self):
         app = App.get_running_app()
+        book_id = app.book_id
         async def load_details():
             try:
-                book_id = app.book_id
-                book = await get_book(book_id)
-                self.ids.title_label.text = f'Название: {book["title"]}'
-                self.ids.author_label.text = f'Автор: {book["author_name"]}'
-                self.ids.genre_label.text = f'Жанр: {book["genre"]}'
-                self.ids.description_label.text = f'Описание: {book["description"]}'
-                self.ids.available_label.text = f'Доступно: {book["available_quantity"]}'
+                book = None
+                if app.db_ready:
+                    try:
+                        book = await app.tasks.shared(('book', book_id),
+                                                      lambda: get_book(book_id))
+                    except Exception as e:
+                        logger.error("Ошибка загрузки деталей книги из базы: %s", e)
+                if book is None and app.snapshot.ready:
+                    book = await app.snapshot.get_book(book_id)
+                if book is None:
+                    # Книгу удалили или ее еще нет в локальном снимке
+                    self.ids.title_label.text = 'Книга не найдена'
+                    self.ids.author_label.text = ''
+                    self.ids.genre_label.text = ''
+                    self.ids.description_label.text = ''
+                    self.ids.available_label.text = ''
+                    return
+                self.ids.title_label.text = f'Название: {book.title}'
+                self.ids.author_label.text = f'Автор: {book.author_name}'
+                self.ids.genre_label.text = f'Жанр: {book.genre}'
+                self.ids.description_label.text = f'Описание: {book.description}'
+                self.ids.available_label.text = f'Доступно: {book.available_quantity}'
             except Exception as e:
-                print(f'Ошибка загрузки деталей книги: {str(e)}')
+                logger.error("Ошибка загрузки деталей книги: %s", e)
         
-        future = app.loop.create_task(load_details())
+        app.tasks.submit(self, 'details', load_details, 'load_book_details')
+
+    def on_leave(self):
+        App.get_running_app().tasks.cancel(self)
 
     def borrow_book(self):
         app = App.get_running_app()
+        if app.current_user is None:
+            self.ids.status_label.text = 'Войдите, чтобы взять книгу'
+            return
         async def do_borrow():
             try:
                 book_id = app.book_id
                 user_id = app.current_user['id']
+                # Новый остаток придет уведомлением об изменении наличия
                 if await borrow_book(book_id, user_id):
                     self.ids.status_label.text = 'Книга успешно взята'
-                    book = await get_book(book_id)
-                    self.ids.available_label.text = f'Доступно: {book["available_quantity"]}'
                 else:
-                    self.ids.status_label.text = 'Книга недоступна'
+                    self.ids.status_label.text = 'Книга недоступна, ее можно забронировать'
             except Exception as e:
                 self.ids.status_label.text = f'Ошибка: {str(e)}'
         
-        future = app.loop.create_task(do_borrow())
+        future = app.spawn(do_borrow(), 'borrow_book')
+
+    def reserve_book(self):
+        app = App.get_running_app()
+        if app.current_user is None:
+            self.ids.status_label.text = 'Войдите, чтобы забронировать книгу'
+            return
+        async def do_reserve():
+            try:
+                reservation = await reserve_book(app.book_id, app.current_user['id'])
+                self.ids.status_label.text = f'Книга забронирована, место в очереди: {reservation["position"]}'
+            except Exception as e:
+                self.ids.status_label.text = f'Ошибка: {str(e)}'
+        
+        future = app.spawn(do_reserve(), 'reserve_book')
+
+    def on_availability_changed(self, book_id, available_quantity):
+        if book_id == App.get_running_app().book_id:
+            self.ids.available_label.text = f'Доступно: {available_quantity}'
+
+class LoanRow(BoxLayout):
+    loan_id = NumericProperty(0)
+    title = StringProperty('')
+    details = StringProperty('')
+    can_return = BooleanProperty(False)
+
+    def return_loan(self):
+        App.get_running_app().root.get_screen('loans').return_loan(self.loan_id)
+
+class LoansScreen(Screen):
+    PAGE_SIZE = 50
+    LOAD_THRESHOLD = 0.2
+    DATE_FORMAT = '%d.%m.%Y'
+
+    # 'mine' - выдачи текущего пользователя, 'overdue' - отчет администратора
+    mode = 'mine'
+    back_screen = 'library_main'
+
+    def open(self, mode, back_screen):
+        self.mode = mode
+        self.back_screen = back_screen
+        self.manager.current = 'loans'
+
+    def on_enter(self):
+        self.ids.header_label.text = 'Просроченные выдачи' if self.mode == 'overdue' else 'Мои книги'
+        self.ids.open_only_checkbox.disabled = self.mode == 'overdue'
+        self.ids.status_label.text = ''
+        self.reset()
+
+    def on_leave(self):
+        App.get_running_app().tasks.cancel(self)
+
+    def reset(self):
+        self.ids.loans_list.data = []
+        self.ids.loans_list.scroll_y = 1
+        self._cursor = None
+        self._exhausted = False
+        self._loading = False
+        self.load_next_page()
+
+    def on_loans_scroll(self, scroll_y):
+        if scroll_y <= self.LOAD_THRESHOLD:
+            self.load_next_page()
+
+    def load_next_page(self):
+        if self._loading or self._exhausted:
+            return
+        self._loading = True
+        app = App.get_running_app()
+        async def load_page():
+            try:
+                if self.mode == 'overdue':
+                    after_due, after_id = self._cursor or (None, 0)
+                    loans = await get_overdue_loans(after_due, after_id, self.PAGE_SIZE)
+                    if loans:
+                        self._cursor = (loans[-1].due_date, loans[-1].id)
+                else:
+                    loans = await get_user_loans(app.current_user['id'], self._cursor, self.PAGE_SIZE,
+                                                 open_only=self.ids.open_only_checkbox.active)
+                    if loans:
+                        self._cursor = loans[-1].id
+                if len(loans) < self.PAGE_SIZE:
+                    self._exhausted = True
+                self.ids.loans_list.data.extend(self.loan_row(loan) for loan in loans)
+            except Exception as e:
+                logger.error("Ошибка загрузки выдач: %s", e)
+                self.ids.status_label.text = f'Ошибка: {str(e)}'
+            finally:
+                self._loading = False
+        
+        app.tasks.submit(self, 'loans', load_page, 'load_loans_page')
+
+    def loan_row(self, loan):
+        due = loan.due_date.strftime(self.DATE_FORMAT)
+        if self.mode == 'overdue':
+            details = f'{loan.username}, срок {due}'
+            can_return = True
+        elif loan.is_returned:
+            details = f'Возвращена {loan.return_date.strftime(self.DATE_FORMAT)}'
+            can_return = False
+        else:
+            details = f'Вернуть до {due}' + (' - просрочена' if loan.is_overdue else '')
+            can_return = True
+        return {
+            'loan_id': loan.id,
+            'title': loan.title,
+            'details': details,
+            'can_return': can_return,
+        }
+
+    def return_loan(self, loan_id):
+        app = App.get_running_app()
+        # Администратор со стойки возвращает любую выдачу, читатель - только свою
+        user_id = None if self.mode == 'overdue' else app.current_user['id']
+        async def do_return():
+            try:
+                if await return_loan(loan_id, user_id):
+                    self.ids.status_label.text = 'Книга возвращена'
+                    self.reset()
+                else:
+                    self.ids.status_label.text = 'Выдача уже закрыта'
+            except Exception as e:
+                self.ids.status_label.text = f'Ошибка: {str(e)}'
+        
+        future = app.spawn(do_return(), 'return_loan')
+
+class AuthorSuggestion(Button):
+    author_id = NumericProperty(0)
+    name = StringProperty('')
+    book_count = NumericProperty(0)
+
+    def on_press(self):
+        App.get_running_app().root.get_screen('admin_panel').select_author(self.author_id, self.name)
 
 class AdminPanelScreen(Screen):
+    AUTHOR_LOOKUP_DELAY = 0.25
+    AUTHOR_LOOKUP_LIMIT = 10
+
+    _lookup_event = None
+    selected_author_id = None
+    selected_author_name = None
+
+    def on_author_text(self, text):
+        # Текст, подставленный выбором из списка, повторно не ищется
+        if text == self.selected_author_name:
+            return
+        self.selected_author_id = None
+        self.selected_author_name = None
+        if self._lookup_event is not None:
+            self._lookup_event.cancel()
+        self._lookup_event = Clock.schedule_once(lambda dt: self.lookup_authors(text),
+                                                 self.AUTHOR_LOOKUP_DELAY)
+
+    def lookup_authors(self, text):
+        app = App.get_running_app()
+        if not text.strip():
+            app.tasks.cancel(self, 'authors')
+            self.ids.author_suggestions.data = []
+            return
+        async def do_lookup():
+            try:
+                authors = await lookup_authors(text, self.AUTHOR_LOOKUP_LIMIT)
+                self.ids.author_suggestions.data = [{
+                    'author_id': author.id,
+                    'name': author.name,
+                    'book_count': author.book_count,
+                } for author in authors]
+            except Exception as e:
+                logger.error("Ошибка поиска авторов: %s", e)
+        
+        # Незавершенный запрос по предыдущему тексту отменяется вместе с запросом к базе
+        app.tasks.submit(self, 'authors', do_lookup, 'lookup_authors')
+
+    STATS_DAYS = 14
+    STATS_TOP_BOOKS = 10
+
+    def load_stats(self):
+        # Отчеты читают агрегаты analytics.py, а не таблицы выдач
+        app = App.get_running_app()
+        async def do_load_stats():
+            try:
+                daily, books, genres = await asyncio.gather(
+                    loans_per_day(self.STATS_DAYS),
+                    top_books(self.STATS_TOP_BOOKS),
+                    genre_utilization(),
+                )
+                lines = [f'Выдачи и возвраты за {self.STATS_DAYS} дней:']
+                lines += [f'  {row.day.strftime("%d.%m")}: {row.loans} / {row.returns}'
+                          for row in daily]
+                lines.append('Самые популярные книги:')
+                lines += [f'  {row.title}: {row.loans} (на руках {row.on_loan})' for row in books]
+                lines.append('Загрузка фонда по жанрам:')
+                lines += [f'  {row.genre}: {row.on_loan} из {row.copies} '
+                          f'({(row.utilization or 0) * 100:.0f}%)' for row in genres]
+                self.ids.stats_label.text = '\n'.join(lines)
+            except Exception as e:
+                logger.error("Ошибка загрузки статистики: %s", e)
+                self.ids.stats_label.text = f'Ошибка: {str(e)}'
+        
+        app.tasks.submit(self, 'stats', do_load_stats, 'load_stats')
+
+    def select_author(self, author_id, name):
+        self.selected_author_id = author_id
+        self.selected_author_name = name
+        self.ids.author_input.text = name
+        self.ids.author_suggestions.data = []
+
     def add_book(self):
         app = App.get_running_app()
         async def do_add_book():
             try:
                 title = self.ids.book_title_input.text
-                author_id = int(self.ids.author_id_input.text)
+                author_id = self.selected_author_id
+                if author_id is None:
+                    raise ValueError('Выберите автора из списка')
                 genre = self.ids.genre_input.text
                 description = self.ids.description_input.text
                 quantity = int(self.ids.quantity_input.text)
@@ -188,7 +632,7 @@ class AdminPanelScreen(Screen):
             except Exception as e:
                 self.ids.status_label.text = f'Ошибка: {str(e)}'
         
-        future = app.loop.create_task(do_add_book())
+        future = app.spawn(do_add_book(), 'add_book')
 
     def add_author(self):
         app = App.get_running_app()
@@ -202,52 +646,179 @@ class AdminPanelScreen(Screen):
             except Exception as e:
                 self.ids.status_label.text = f'Ошибка: {str(e)}'
         
-        future = app.loop.create_task(do_add_author())
+        future = app.spawn(do_add_author(), 'add_author')
 
-class MainApp(App):
-    def build(self):
-        print("Инициализация приложения")
-        self.current_user = None
-        self.book_id = None
-        
+class BookEditRow(RecycleDataViewBehavior, BoxLayout):
+    book_id = NumericProperty(0)
+    title = StringProperty('')
+    genre = StringProperty('')
+    quantity = StringProperty('')
+    details = StringProperty('')
+
+    _refreshing = False
+
+    def refresh_view_attrs(self, rv, index, data):
+        # Строка переиспользуется для другой книги: подстановка ее значений
+        # в поля ввода - не правка
+        self._refreshing = True
         try:
-            self.loop = asyncio.get_event_loop()
-            print("Получен существующий event loop")
-        except RuntimeError:
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-            print("Создан новый event loop")
-        
-        async def init_db():
-            print("Начало инициализации базы данных")
+            return super().refresh_view_attrs(rv, index, data)
+        finally:
+            self._refreshing = False
+
+    def on_edit(self, field, value):
+        if not self._refreshing:
+            App.get_running_app().root.get_screen('bulk_edit').set_edit(self.book_id, field, value)
+
+class BulkEditScreen(Screen):
+    PAGE_SIZE = 100
+    LOAD_THRESHOLD = 0.2
+    STATUS_TEXT = {
+        'updated': 'сохранено',
+        'conflict': 'изменена другим администратором, загрузите заново',
+        'insufficient': 'на руках больше экземпляров',
+        'missing': 'книга удалена',
+    }
+
+    def on_enter(self):
+        self.reset()
+
+    def on_leave(self):
+        App.get_running_app().tasks.cancel(self)
+
+    def reset(self):
+        # book_id -> {поле: новое значение}; версии берутся из строк списка
+        self._edits = {}
+        self._row_index = {}
+        self.ids.edit_list.data = []
+        self.ids.edit_list.scroll_y = 1
+        self.ids.status_label.text = ''
+        self._last_id = 0
+        self._exhausted = False
+        self._loading = False
+        self.load_next_page()
+
+    def on_edit_scroll(self, scroll_y):
+        if scroll_y <= self.LOAD_THRESHOLD:
+            self.load_next_page()
+
+    def load_next_page(self):
+        if self._loading or self._exhausted:
+            return
+        self._loading = True
+        app = App.get_running_app()
+        async def load_page():
             try:
-                await db_instance.create_pool()
-                print("База данных успешно инициализирована")
-                
-                # Проверяем подключение, пытаясь выполнить простой запрос
-                pool = await db_instance.get_pool()
-                async with pool.acquire() as conn:
-                    await conn.fetchval('SELECT 1')
-                print("Подключение к базе данных проверено")
-                
-                return True
+                books = await get_books_for_edit(self._last_id, self.PAGE_SIZE)
+                if len(books) < self.PAGE_SIZE:
+                    self._exhausted = True
+                if books:
+                    self._last_id = books[-1].id
+                    data = self.ids.edit_list.data
+                    for i, book in enumerate(books, start=len(data)):
+                        self._row_index[book.id] = i
+                    data.extend(self.edit_row(book) for book in books)
             except Exception as e:
-                print(f"Ошибка при инициализации базы данных: {e}")
-                print(f"Тип ошибки: {type(e).__name__}")
-                return False
+                logger.error("Ошибка загрузки книг для правки: %s", e)
+                self.ids.status_label.text = f'Ошибка: {str(e)}'
+            finally:
+                self._loading = False
         
-        print("Запуск инициализации базы данных")
-        future = self.loop.create_task(init_db())
+        app.tasks.submit(self, 'books', load_page, 'load_books_for_edit')
+
+    @staticmethod
+    def edit_row(book):
+        return {
+            'book_id': book.id,
+            'title': book.title,
+            'genre': book.genre or '',
+            'quantity': str(book.quantity),
+            'details': f'в наличии {book.available_quantity}',
+            'version': book.version,
+            'original': {'genre': book.genre or '', 'quantity': str(book.quantity)},
+        }
+
+    def set_edit(self, book_id, field, value):
+        index = self._row_index[book_id]
+        row = self.ids.edit_list.data[index]
+        # Значение хранится и в данных списка, чтобы пережить переиспользование строк
+        row[field] = value
+        edits = self._edits.setdefault(book_id, {})
+        if value == row['original'][field]:
+            edits.pop(field, None)
+            if not edits:
+                del self._edits[book_id]
+        else:
+            edits[field] = value
+        self.ids.status_label.text = f'Изменено книг: {len(self._edits)}'
+
+    def save(self):
+        app = App.get_running_app()
+        data = self.ids.edit_list.data
         try:
-            self.loop.run_until_complete(future)
-            if not future.result():
-                print("Не удалось инициализировать базу данных")
-                return None
-        except Exception as e:
-            print(f"Критическая ошибка при инициализации: {e}")
-            return None
+            edits = []
+            for book_id, fields in self._edits.items():
+                edit = {'id': book_id, 'version': data[self._row_index[book_id]]['version']}
+                if 'genre' in fields:
+                    edit['genre'] = fields['genre'] or None
+                if 'quantity' in fields:
+                    edit['quantity'] = int(fields['quantity'])
+                edits.append(edit)
+        except ValueError:
+            self.ids.status_label.text = 'Ошибка: количество должно быть целым числом'
+            return
+        if not edits:
+            self.ids.status_label.text = 'Нет изменений'
+            return
+        async def do_save():
+            try:
+                results = await update_books(edits)
+                saved = 0
+                for result in results:
+                    index = self._row_index[result.id]
+                    row = dict(data[index], details=self.STATUS_TEXT[result.status])
+                    if result.status == 'updated':
+                        saved += 1
+                        self._edits.pop(result.id, None)
+                        row['version'] = result.version
+                        row['original'] = {'genre': row['genre'], 'quantity': row['quantity']}
+                        row['details'] += f', в наличии {result.available_quantity}'
+                    data[index] = row
+                self.ids.status_label.text = (
+                    f'Сохранено: {saved}, не сохранено: {len(results) - saved}'
+                )
+            except Exception as e:
+                self.ids.status_label.text = f'Ошибка: {str(e)}'
         
-        print("Event loop и база данных готовы")
+        app.tasks.submit(self, 'save', do_save, 'update_books')
+
+class MainApp(App):
+    # Сколько последних замеров задержки хранить на каждый тип задачи
+    LATENCY_HISTORY = 1000
+    DB_RETRY_DELAY = 5
+    SNAPSHOT_SYNC_INTERVAL = 60
+    # Одновременных загрузок данных на экран
+    LOADS_PER_SCREEN = 2
+
+    # Вход и регистрация доступны, когда пул готов; интерфейс рисуется раньше
+    db_ready = BooleanProperty(False)
+    # Просмотр каталога без входа доступен, когда в локальном снимке есть данные
+    snapshot_ready = BooleanProperty(False)
+    current_user = ObjectProperty(None, allownone=True)
+
+    def build(self):
+        logger.info("Инициализация приложения")
+        self.current_user = None
+        self.book_id = None
+        self.latencies = {}
+        self.startup = {'imports_ms': (IMPORTS_DONE_AT - STARTED_AT) * 1000}
+        self.snapshot = CatalogSnapshot(fetch_changes=get_catalog_changes)
+        self.tasks = TaskScheduler(self.spawn, max_per_owner=self.LOADS_PER_SCREEN)
+        
+        # build вызывается из async_run, поэтому Kivy и запросы к БД
+        # разделяют один запущенный event loop в главном потоке
+        self.loop = asyncio.get_running_loop()
+        self.spawn(self.init_db(), 'init_db')
         
         sm = ScreenManager()
         sm.add_widget(LoginScreen(name='login'))
@@ -255,44 +826,160 @@ class MainApp(App):
         sm.add_widget(LibraryMainScreen(name='library_main'))
         sm.add_widget(BookDetailsScreen(name='book_details'))
         sm.add_widget(AdminPanelScreen(name='admin_panel'))
+        sm.add_widget(LoansScreen(name='loans'))
+        sm.add_widget(BulkEditScreen(name='bulk_edit'))
         return sm
 
-    def on_stop(self):
-        async def close_db():
-            await db_instance.close_pool()
-        
-        self.loop.run_until_complete(close_db())
-        self.loop.close()
+    def on_start(self):
+        # Отложенный на 0 секунд вызов выполняется после отрисовки первого кадра
+        Clock.schedule_once(self.on_first_frame)
 
-if __name__ == "__main__":
-    print("Запуск приложения")
-    try:
-        print("Создание экземпляра приложения")
-        app = MainApp()
+    def on_first_frame(self, dt):
+        self.startup['first_frame_ms'] = (time.perf_counter() - STARTED_AT) * 1000
+        self.report_startup()
+
+    async def init_db(self):
+        logger.debug("Начало инициализации базы данных")
+        try:
+            await self.snapshot.open()
+            self.snapshot_ready = self.snapshot.ready
+        except Exception as e:
+            logger.error("Не удалось открыть локальный снимок каталога: %s", e)
         
-        print("Проверка подключения к базе данных")
-        async def test_db():
+        while True:
             try:
-                pool = await db_instance.get_pool()
-                async with pool.acquire() as conn:
-                    result = await conn.fetchval('SELECT 1')
-                    print("Подключение к базе данных успешно")
-                    return True
+                if API_URL:
+                    await client.check_health()
+                else:
+                    await db_instance.create_pool()
+                break
             except Exception as e:
-                print(f"Ошибка подключения к базе данных: {str(e)}")
-                return False
+                logger.error("Ошибка при инициализации базы данных (%s): %s", type(e).__name__, e)
+                self.root.get_screen('login').show_error(
+                    'Нет подключения к базе данных, повторная попытка...'
+                )
+                await asyncio.sleep(self.DB_RETRY_DELAY)
+        self.root.get_screen('login').show_error('')
         
-        loop = asyncio.get_event_loop()
-        if not loop.run_until_complete(test_db()):
-            print("Не удалось подключиться к базе данных")
-            input("Нажмите Enter для выхода...")
-            sys.exit(1)
+        if API_URL:
+            # Сервис пересылает уведомления базы по websocket
+            self.spawn(client.listen_availability(self.on_availability_changed),
+                       'availability_events')
+        else:
+            try:
+                await start_invalidation_listener()
+                await db_instance.add_listener(AVAILABILITY_CHANNEL, self.on_availability_notify)
+            except Exception as e:
+                logger.error("Не удалось подписаться на уведомления базы данных: %s", e)
         
-        print("Запуск главного цикла приложения")
-        app.run()
+        # Прогрев: первая страница каталога оседает в кэше, а ее запрос -
+        # в кэше подготовленных выражений соединения
+        started = time.perf_counter()
+        try:
+            await get_books_page(0, LibraryMainScreen.PAGE_SIZE)
+        except Exception as e:
+            logger.error("Ошибка прогрева каталога: %s", e)
+        self.startup['warmup_ms'] = (time.perf_counter() - started) * 1000
+        
+        self.db_ready = True
+        self.startup['db_ready_ms'] = (time.perf_counter() - STARTED_AT) * 1000
+        logger.info("База данных успешно инициализирована")
+        self.report_startup()
+        self.spawn(self.sync_snapshot(), 'sync_snapshot')
+
+    async def sync_snapshot(self):
+        # Первая синхронизация загружает каталог целиком, следующие - только изменения
+        while True:
+            if self.snapshot.is_open:
+                try:
+                    await self.snapshot.sync()
+                    self.snapshot_ready = True
+                except Exception as e:
+                    logger.error("Ошибка синхронизации снимка каталога: %s", e)
+            await asyncio.sleep(self.SNAPSHOT_SYNC_INTERVAL)
+
+    def report_startup(self):
+        # Отчет выводится, когда известны и первый кадр, и готовность базы
+        if not PROFILE_STARTUP or 'first_frame_ms' not in self.startup \
+                or 'db_ready_ms' not in self.startup:
+            return
+        profile = dict(self.startup, **db_instance.timings)
+        logger.info("Профиль запуска: %s", ', '.join(
+            f'{name}={value:.1f}' for name, value in profile.items()
+        ))
+        self.report_latencies()
+
+    def report_latencies(self):
+        # Задержка от действия пользователя до отрисовки результата по задачам
+        stats = self.latency_stats()
+        if stats:
+            logger.info("Задержки задач: %s", ', '.join(
+                f"{name}: p50={item['p50_ms']:.1f} max={item['max_ms']:.1f} мс (n={item['count']})"
+                for name, item in sorted(stats.items())
+            ))
+
+    def on_stop(self):
+        # Итог за весь сеанс: отчет при запуске застает только первые загрузки
+        if PROFILE_STARTUP:
+            self.report_latencies()
+
+    def on_availability_notify(self, connection, pid, channel, payload):
+        # Формат сообщения: "<book_id>:<available_quantity>"
+        book_id, available_quantity = map(int, payload.split(':'))
+        self.on_availability_changed(book_id, available_quantity)
+
+    def on_availability_changed(self, book_id, available_quantity):
+        if self.snapshot.ready:
+            self.spawn(self.snapshot.set_availability(book_id, available_quantity),
+                       'snapshot_availability')
+        for screen in self.root.screens:
+            if hasattr(screen, 'on_availability_changed'):
+                screen.on_availability_changed(book_id, available_quantity)
+
+    def spawn(self, coro, name: str):
+        started = time.perf_counter()
+        
+        def record_latency(task):
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            history = self.latencies.setdefault(name, deque(maxlen=self.LATENCY_HISTORY))
+            history.append(elapsed_ms)
+            logger.debug("Задача %s завершена за %.1f мс", name, elapsed_ms)
+        
+        task = self.loop.create_task(coro)
+        task.add_done_callback(record_latency)
+        return task
+
+    def latency_stats(self) -> dict:
+        stats = {}
+        for name, history in self.latencies.items():
+            ordered = sorted(history)
+            stats[name] = {
+                'count': len(ordered),
+                'p50_ms': ordered[len(ordered) // 2],
+                'max_ms': ordered[-1],
+            }
+        return stats
+
+async def run_app():
+    app = MainApp()
+    try:
+        logger.info("Запуск главного цикла приложения")
+        await app.async_run(async_lib='asyncio')
+    finally:
+        await app.snapshot.close()
+        if API_URL:
+            await client.close()
+        else:
+            await db_instance.close_pool()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=os.environ.get('LIBRARY_LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+    )
+    logger.info("Запуск приложения")
+    try:
+        asyncio.run(run_app())
     except Exception as e:
-        print(f"Критическая ошибка при запуске приложения: {str(e)}")
-        print("Детали ошибки:", e.__class__.__name__)
-        import traceback
-        traceback.print_exc()
-        input("Нажмите Enter для выхода...")
\ No newline at end of file
+        logger.exception("Критическая ошибка при запуске приложения: %s", e)
+        input("Нажмите Enter для выхода...")
@@ -0,0 +1,532 @@
+import asyncpg
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки, под которой миграции применяются одним процессом
+MIGRATION_LOCK_KEY = 7_160_001
+
+# Предел для долгих служебных операций (миграции, пересчет статистики, импорт).
+# asyncpg подставляет command_timeout пула вместо timeout=None, поэтому
+# такие операции передают явный таймаут, а statement_timeout снимают SET LOCAL
+MAINTENANCE_TIMEOUT = 24 * 3600.0
+
+# Миграции применяются по порядку и никогда не меняются после выпуска:
+# изменения схемы добавляются только новыми версиями в конец списка.
+# Первые версии написаны идемпотентно, чтобы подхватить базы, созданные
+# до появления schema_version.
+MIGRATIONS = [
+    (1, 'Базовые таблицы', '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            password VARCHAR(100) NOT NULL,
+            is_admin BOOLEAN DEFAULT FALSE
+        );
+        CREATE TABLE IF NOT EXISTS authors (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            biography TEXT
+        );
+        CREATE TABLE IF NOT EXISTS books (
+            id SERIAL PRIMARY KEY,
+            title VARCHAR(200) NOT NULL,
+            author_id INTEGER REFERENCES authors(id),
+            genre VARCHAR(50),
+            description TEXT,
+            quantity INTEGER DEFAULT 1,
+            available_quantity INTEGER DEFAULT 1
+        );
+        CREATE TABLE IF NOT EXISTS book_loans (
+            id SERIAL PRIMARY KEY,
+            book_id INTEGER REFERENCES books(id),
+            user_id INTEGER REFERENCES users(id),
+            loan_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            return_date TIMESTAMP,
+            is_returned BOOLEAN DEFAULT FALSE
+        );
+    '''),
+    (2, 'Полнотекстовый и триграммный поиск', '''
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+        ) STORED;
+        CREATE INDEX IF NOT EXISTS books_search_vector_idx ON books USING GIN (search_vector);
+        CREATE INDEX IF NOT EXISTS authors_name_trgm_idx ON authors USING GIN (name gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS authors_name_idx ON authors (name);
+    '''),
+    (3, 'Триггеры инвалидации кэша', '''
+        CREATE OR REPLACE FUNCTION notify_cache_invalidation() RETURNS trigger AS $$
+        BEGIN
+            IF TG_LEVEL = 'ROW' THEN
+                PERFORM pg_notify('library_cache', TG_TABLE_NAME || ':' || OLD.id);
+            ELSE
+                PERFORM pg_notify('library_cache', TG_TABLE_NAME || ':');
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Вставки уведомляют один раз на оператор, чтобы COPY не порождал
+        -- по сообщению на строку
+        DROP TRIGGER IF EXISTS books_cache_row ON books;
+        CREATE TRIGGER books_cache_row AFTER UPDATE OR DELETE ON books
+            FOR EACH ROW EXECUTE FUNCTION notify_cache_invalidation();
+        DROP TRIGGER IF EXISTS books_cache_insert ON books;
+        CREATE TRIGGER books_cache_insert AFTER INSERT ON books
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_cache_invalidation();
+        DROP TRIGGER IF EXISTS authors_cache_row ON authors;
+        CREATE TRIGGER authors_cache_row AFTER UPDATE OR DELETE ON authors
+            FOR EACH ROW EXECUTE FUNCTION notify_cache_invalidation();
+        DROP TRIGGER IF EXISTS authors_cache_insert ON authors;
+        CREATE TRIGGER authors_cache_insert AFTER INSERT ON authors
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_cache_invalidation();
+    '''),
+    (4, 'Индексы под запросы выдачи и каталога', '''
+        -- return_book: открытые выдачи пользователя по книге, самая ранняя первой
+        CREATE INDEX IF NOT EXISTS book_loans_open_idx
+            ON book_loans (book_id, user_id, loan_date) WHERE is_returned = FALSE;
+        -- внешние ключи book_loans: удаление книг и пользователей, выборки по книге
+        CREATE INDEX IF NOT EXISTS book_loans_book_id_idx ON book_loans (book_id);
+        CREATE INDEX IF NOT EXISTS book_loans_user_id_idx ON book_loans (user_id);
+        -- соединение с authors и постраничные выборки с фильтрами
+        CREATE INDEX IF NOT EXISTS books_author_id_idx ON books (author_id, id);
+        CREATE INDEX IF NOT EXISTS books_genre_idx ON books (genre, id);
+        CREATE INDEX IF NOT EXISTS books_available_idx ON books (id) WHERE available_quantity > 0;
+    '''),
+    (5, 'Место под соленые хеши паролей scrypt', '''
+        ALTER TABLE users ALTER COLUMN password TYPE VARCHAR(255);
+    '''),
+    (6, 'Сроки возврата и индексы истории и просрочек', '''
+        ALTER TABLE book_loans ADD COLUMN IF NOT EXISTS due_date TIMESTAMP;
+        UPDATE book_loans SET due_date = loan_date + INTERVAL '14 days' WHERE due_date IS NULL;
+        ALTER TABLE book_loans ALTER COLUMN due_date SET DEFAULT CURRENT_TIMESTAMP + INTERVAL '14 days';
+        -- история пользователя листается от новых выдач к старым по id
+        DROP INDEX IF EXISTS book_loans_user_id_idx;
+        CREATE INDEX IF NOT EXISTS book_loans_user_history_idx ON book_loans (user_id, id DESC);
+        CREATE INDEX IF NOT EXISTS book_loans_user_open_idx
+            ON book_loans (user_id, id DESC) WHERE is_returned = FALSE;
+        -- отчет о просрочках читает только открытые выдачи в порядке срока
+        CREATE INDEX IF NOT EXISTS book_loans_overdue_idx
+            ON book_loans (due_date, id) WHERE is_returned = FALSE;
+    '''),
+    (7, 'Очередь броней', '''
+        CREATE TABLE IF NOT EXISTS reservations (
+            id SERIAL PRIMARY KEY,
+            book_id INTEGER NOT NULL REFERENCES books(id),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status VARCHAR(20) NOT NULL DEFAULT 'waiting',
+            loan_id INTEGER REFERENCES book_loans(id),
+            fulfilled_at TIMESTAMP
+        );
+        -- очередь книги в порядке постановки и выборка диспетчера
+        CREATE INDEX IF NOT EXISTS reservations_queue_idx
+            ON reservations (book_id, id) WHERE status = 'waiting';
+        CREATE INDEX IF NOT EXISTS reservations_waiting_idx
+            ON reservations (id) WHERE status = 'waiting';
+        -- не больше одной ожидающей брони пользователя на книгу
+        CREATE UNIQUE INDEX IF NOT EXISTS reservations_user_book_idx
+            ON reservations (user_id, book_id) WHERE status = 'waiting';
+
+        -- Возврат экземпляра книги с очередью будит диспетчеры
+        CREATE OR REPLACE FUNCTION notify_reservations() RETURNS trigger AS $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM reservations WHERE book_id = NEW.id AND status = 'waiting') THEN
+                PERFORM pg_notify('library_reservations', NEW.id::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS books_reservations ON books;
+        CREATE TRIGGER books_reservations AFTER UPDATE OF available_quantity ON books
+            FOR EACH ROW WHEN (NEW.available_quantity > OLD.available_quantity)
+            EXECUTE FUNCTION notify_reservations();
+    '''),
+    (8, 'Уведомления об изменении наличия книг', '''
+        CREATE OR REPLACE FUNCTION notify_availability() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('library_availability', NEW.id || ':' || NEW.available_quantity);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS books_availability ON books;
+        CREATE TRIGGER books_availability AFTER UPDATE OF available_quantity ON books
+            FOR EACH ROW WHEN (NEW.available_quantity IS DISTINCT FROM OLD.available_quantity)
+            EXECUTE FUNCTION notify_availability();
+    '''),
+    (9, 'Номера транзакций изменений каталога для инкрементальной синхронизации', '''
+        -- Строка хранит транзакцию, изменившую ее последней. Номер из
+        -- последовательности выдавался бы до фиксации, и строка долгой
+        -- транзакции (импорт, пакетная правка) могла бы стать видна ниже уже
+        -- прочитанного клиентом номера; граница по транзакциям продвигается
+        -- только до xmin снимка, ниже которого все транзакции завершены.
+        -- Константа для существующих строк не переписывает таблицы
+        ALTER TABLE books ADD COLUMN IF NOT EXISTS change_xid xid8 NOT NULL DEFAULT '1';
+        ALTER TABLE authors ADD COLUMN IF NOT EXISTS change_xid xid8 NOT NULL DEFAULT '1';
+        ALTER TABLE books ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+        ALTER TABLE authors ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+        CREATE INDEX IF NOT EXISTS books_change_xid_idx ON books (change_xid, id);
+        CREATE INDEX IF NOT EXISTS authors_change_xid_idx ON authors (change_xid, id);
+
+        -- Любое изменение строки записывает в нее текущую транзакцию
+        CREATE OR REPLACE FUNCTION bump_change_xid() RETURNS trigger AS $$
+        BEGIN
+            NEW.change_xid := pg_current_xact_id();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS books_change_xid ON books;
+        CREATE TRIGGER books_change_xid BEFORE UPDATE ON books
+            FOR EACH ROW EXECUTE FUNCTION bump_change_xid();
+        DROP TRIGGER IF EXISTS authors_change_xid ON authors;
+        CREATE TRIGGER authors_change_xid BEFORE UPDATE ON authors
+            FOR EACH ROW EXECUTE FUNCTION bump_change_xid();
+    '''),
+    (10, 'Префиксный индекс имен авторов для автодополнения', '''
+        -- Поиск по префиксу без учета регистра читает диапазон этого индекса
+        -- уже в нужном порядке. Диапазон, в отличие от LIKE $1, использует
+        -- индекс и в общем плане подготовленного выражения
+        CREATE INDEX IF NOT EXISTS authors_name_prefix_idx
+            ON authors ((lower(name) COLLATE "C"), id);
+    '''),
+    (11, 'Счетчики фасетов каталога по жанрам и авторам', '''
+        -- Книги без жанра учитываются под жанром '', без автора - под author_id 0.
+        -- total - число книг, available - число книг с экземплярами в наличии
+        CREATE TABLE IF NOT EXISTS book_facets (
+            genre VARCHAR(50) NOT NULL,
+            author_id INTEGER NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            available INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (genre, author_id)
+        );
+        CREATE TABLE IF NOT EXISTS genre_facets (
+            genre VARCHAR(50) PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            available INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS author_facets (
+            author_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            available INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS book_facets_author_idx ON book_facets (author_id, genre);
+        CREATE INDEX IF NOT EXISTS author_facets_top_idx ON author_facets (total DESC, author_id);
+        -- постраничные выборки каталога с фильтром по наличию
+        CREATE INDEX IF NOT EXISTS books_genre_available_idx
+            ON books (genre, id) WHERE available_quantity > 0;
+        CREATE INDEX IF NOT EXISTS books_author_available_idx
+            ON books (author_id, id) WHERE available_quantity > 0;
+
+        -- Счетчики ведутся триггерами уровня оператора по переходным таблицам:
+        -- одна пачка приращений на оператор, а не на строку. Строки с нулевым
+        -- приращением пропускаются, поэтому выдача, после которой у книги
+        -- остаются экземпляры, счетчики не трогает. Строки счетчиков
+        -- обновляются в порядке ключа, чтобы пакетные операторы не
+        -- взаимоблокировались
+        CREATE OR REPLACE FUNCTION maintain_book_facets() RETURNS trigger AS $$
+        DECLARE
+            changes TEXT;
+        BEGIN
+            changes := CASE TG_OP
+                WHEN 'INSERT' THEN 'SELECT genre, author_id, available_quantity, 1 AS sign FROM new_rows'
+                WHEN 'DELETE' THEN 'SELECT genre, author_id, available_quantity, -1 AS sign FROM old_rows'
+                ELSE 'SELECT genre, author_id, available_quantity, 1 AS sign FROM new_rows
+                      UNION ALL
+                      SELECT genre, author_id, available_quantity, -1 AS sign FROM old_rows'
+            END;
+            EXECUTE format($sql$
+                WITH delta AS (
+                    SELECT coalesce(genre, '') AS genre, coalesce(author_id, 0) AS author_id,
+                           sum(sign)::int AS total,
+                           sum(sign) FILTER (WHERE available_quantity > 0)::int AS available
+                    FROM (%s) c
+                    GROUP BY 1, 2
+                    HAVING sum(sign) <> 0 OR coalesce(sum(sign) FILTER (WHERE available_quantity > 0), 0) <> 0
+                ), genres AS (
+                    INSERT INTO genre_facets AS f (genre, total, available)
+                    SELECT genre, sum(total), coalesce(sum(available), 0) FROM delta
+                    GROUP BY genre ORDER BY genre
+                    ON CONFLICT (genre) DO UPDATE
+                        SET total = f.total + excluded.total, available = f.available + excluded.available
+                ), authors AS (
+                    INSERT INTO author_facets AS f (author_id, total, available)
+                    SELECT author_id, sum(total), coalesce(sum(available), 0) FROM delta
+                    GROUP BY author_id ORDER BY author_id
+                    ON CONFLICT (author_id) DO UPDATE
+                        SET total = f.total + excluded.total, available = f.available + excluded.available
+                )
+                INSERT INTO book_facets AS f (genre, author_id, total, available)
+                SELECT genre, author_id, total, coalesce(available, 0) FROM delta
+                ORDER BY genre, author_id
+                ON CONFLICT (genre, author_id) DO UPDATE
+                    SET total = f.total + excluded.total, available = f.available + excluded.available
+            $sql$, changes);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS books_facets_insert ON books;
+        CREATE TRIGGER books_facets_insert AFTER INSERT ON books
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION maintain_book_facets();
+        DROP TRIGGER IF EXISTS books_facets_update ON books;
+        CREATE TRIGGER books_facets_update AFTER UPDATE ON books
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION maintain_book_facets();
+        DROP TRIGGER IF EXISTS books_facets_delete ON books;
+        CREATE TRIGGER books_facets_delete AFTER DELETE ON books
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION maintain_book_facets();
+
+        -- Начальное заполнение; блокировка не дает записям проскочить между
+        -- подсчетом и включением триггеров
+        LOCK TABLE books IN SHARE ROW EXCLUSIVE MODE;
+        TRUNCATE book_facets, genre_facets, author_facets;
+        INSERT INTO book_facets (genre, author_id, total, available)
+        SELECT coalesce(genre, ''), coalesce(author_id, 0), count(*),
+               count(*) FILTER (WHERE available_quantity > 0)
+        FROM books GROUP BY 1, 2;
+        INSERT INTO genre_facets (genre, total, available)
+        SELECT genre, sum(total), sum(available) FROM book_facets GROUP BY genre;
+        INSERT INTO author_facets (author_id, total, available)
+        SELECT author_id, sum(total), sum(available) FROM book_facets GROUP BY author_id;
+    '''),
+    (12, 'Агрегаты статистики выдач', '''
+        -- Триггеры book_loans только дописывают строки приращений: выдачи не
+        -- конкурируют за строки агрегатов. Приращения сворачивает в агрегаты
+        -- периодическое задание analytics.py
+        CREATE TABLE IF NOT EXISTS circulation_deltas (
+            id BIGSERIAL PRIMARY KEY,
+            day DATE NOT NULL,
+            book_id INTEGER NOT NULL,
+            loans INTEGER NOT NULL DEFAULT 0,
+            returns INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS loans_daily (
+            day DATE PRIMARY KEY,
+            loans INTEGER NOT NULL DEFAULT 0,
+            returns INTEGER NOT NULL DEFAULT 0
+        );
+        -- genre - жанр, на который записаны счетчики книги в genre_circulation
+        CREATE TABLE IF NOT EXISTS book_circulation (
+            book_id INTEGER PRIMARY KEY,
+            genre VARCHAR(50) NOT NULL,
+            loans BIGINT NOT NULL DEFAULT 0,
+            on_loan INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS book_circulation_top_idx ON book_circulation (loans DESC, book_id);
+        CREATE TABLE IF NOT EXISTS genre_circulation (
+            genre VARCHAR(50) PRIMARY KEY,
+            loans BIGINT NOT NULL DEFAULT 0,
+            on_loan INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE OR REPLACE FUNCTION record_circulation_deltas() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO circulation_deltas (day, book_id, loans)
+                SELECT loan_date::date, book_id, count(*) FROM new_rows GROUP BY 1, 2;
+                -- строки, вставленные уже возвращенными (импорт истории)
+                INSERT INTO circulation_deltas (day, book_id, returns)
+                SELECT coalesce(return_date, loan_date)::date, book_id, count(*)
+                FROM new_rows WHERE is_returned GROUP BY 1, 2;
+            ELSE
+                INSERT INTO circulation_deltas (day, book_id, returns)
+                SELECT coalesce(n.return_date, CURRENT_TIMESTAMP)::date, n.book_id, count(*)
+                FROM new_rows n JOIN old_rows o ON o.id = n.id
+                WHERE n.is_returned AND NOT o.is_returned
+                GROUP BY 1, 2;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS book_loans_circulation_insert ON book_loans;
+        CREATE TRIGGER book_loans_circulation_insert AFTER INSERT ON book_loans
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION record_circulation_deltas();
+        DROP TRIGGER IF EXISTS book_loans_circulation_update ON book_loans;
+        CREATE TRIGGER book_loans_circulation_update AFTER UPDATE ON book_loans
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION record_circulation_deltas();
+
+        -- Смена жанра книги переносит ее счетчики со старого жанра на новый.
+        -- Свертка берет жанр из заблокированной строки book_circulation, а
+        -- перенос идет под той же блокировкой, поэтому правки жанров книг на
+        -- руках не расходятся с агрегатами
+        CREATE OR REPLACE FUNCTION move_genre_circulation() RETURNS trigger AS $$
+        BEGIN
+            -- Выдачи и возвраты жанр не меняют и дальше этой проверки не идут
+            IF NOT EXISTS (SELECT 1 FROM new_rows n JOIN old_rows o ON o.id = n.id
+                           WHERE n.genre IS DISTINCT FROM o.genre) THEN
+                RETURN NULL;
+            END IF;
+
+            -- Строка для книги без свертанных выдач: параллельная свертка
+            -- наткнется на нее и запишет приращения уже на новый жанр
+            INSERT INTO book_circulation (book_id, genre)
+            SELECT n.id, coalesce(n.genre, '')
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE n.genre IS DISTINCT FROM o.genre
+            ORDER BY n.id
+            ON CONFLICT (book_id) DO NOTHING;
+
+            -- Блокировка в порядке ключа, как у свертки, - без взаимоблокировок
+            PERFORM 1 FROM book_circulation c
+            JOIN new_rows n ON n.id = c.book_id JOIN old_rows o ON o.id = n.id
+            WHERE n.genre IS DISTINCT FROM o.genre
+            ORDER BY c.book_id FOR UPDATE OF c;
+
+            WITH moved AS (
+                UPDATE book_circulation c SET genre = coalesce(n.genre, '')
+                FROM new_rows n JOIN old_rows o ON o.id = n.id
+                WHERE c.book_id = n.id AND n.genre IS DISTINCT FROM o.genre
+                  AND c.genre <> coalesce(n.genre, '')
+                RETURNING c.book_id, coalesce(o.genre, '') AS old_genre, c.genre AS new_genre,
+                          c.loans, c.on_loan
+            ), delta AS (
+                SELECT genre, sum(loans) AS loans, sum(on_loan)::int AS on_loan FROM (
+                    SELECT new_genre AS genre, loans, on_loan FROM moved
+                    UNION ALL
+                    SELECT old_genre, -loans, -on_loan FROM moved
+                ) m
+                GROUP BY genre
+                HAVING sum(loans) <> 0 OR sum(on_loan) <> 0
+            )
+            INSERT INTO genre_circulation AS g (genre, loans, on_loan)
+            SELECT genre, loans, on_loan FROM delta ORDER BY genre
+            ON CONFLICT (genre) DO UPDATE
+                SET loans = g.loans + excluded.loans, on_loan = g.on_loan + excluded.on_loan;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS books_genre_circulation ON books;
+        CREATE TRIGGER books_genre_circulation AFTER UPDATE ON books
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION move_genre_circulation();
+
+        -- Число экземпляров по жанрам для загрузки фонда. Меняется только при
+        -- добавлении книг и правке количества, поэтому выдачи счетчик не трогают
+        ALTER TABLE genre_facets ADD COLUMN IF NOT EXISTS copies INTEGER NOT NULL DEFAULT 0;
+        CREATE OR REPLACE FUNCTION maintain_book_facets() RETURNS trigger AS $$
+        DECLARE
+            changes TEXT;
+        BEGIN
+            changes := CASE TG_OP
+                WHEN 'INSERT' THEN 'SELECT genre, author_id, available_quantity, quantity, 1 AS sign FROM new_rows'
+                WHEN 'DELETE' THEN 'SELECT genre, author_id, available_quantity, quantity, -1 AS sign FROM old_rows'
+                ELSE 'SELECT genre, author_id, available_quantity, quantity, 1 AS sign FROM new_rows
+                      UNION ALL
+                      SELECT genre, author_id, available_quantity, quantity, -1 AS sign FROM old_rows'
+            END;
+            EXECUTE format($sql$
+                WITH delta AS (
+                    SELECT coalesce(genre, '') AS genre, coalesce(author_id, 0) AS author_id,
+                           sum(sign)::int AS total,
+                           coalesce(sum(sign) FILTER (WHERE available_quantity > 0), 0)::int AS available,
+                           coalesce(sum(sign * quantity), 0)::int AS copies
+                    FROM (%s) c
+                    GROUP BY 1, 2
+                    HAVING sum(sign) <> 0
+                        OR coalesce(sum(sign) FILTER (WHERE available_quantity > 0), 0) <> 0
+                        OR coalesce(sum(sign * quantity), 0) <> 0
+                ), genres AS (
+                    INSERT INTO genre_facets AS f (genre, total, available, copies)
+                    SELECT genre, sum(total), sum(available), sum(copies) FROM delta
+                    GROUP BY genre ORDER BY genre
+                    ON CONFLICT (genre) DO UPDATE
+                        SET total = f.total + excluded.total, available = f.available + excluded.available,
+                            copies = f.copies + excluded.copies
+                ), authors AS (
+                    INSERT INTO author_facets AS f (author_id, total, available)
+                    SELECT author_id, sum(total), sum(available) FROM delta
+                    WHERE total <> 0 OR available <> 0
+                    GROUP BY author_id ORDER BY author_id
+                    ON CONFLICT (author_id) DO UPDATE
+                        SET total = f.total + excluded.total, available = f.available + excluded.available
+                )
+                INSERT INTO book_facets AS f (genre, author_id, total, available)
+                SELECT genre, author_id, total, available FROM delta
+                WHERE total <> 0 OR available <> 0
+                ORDER BY genre, author_id
+                ON CONFLICT (genre, author_id) DO UPDATE
+                    SET total = f.total + excluded.total, available = f.available + excluded.available
+            $sql$, changes);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Начальное заполнение из истории выдач
+        LOCK TABLE books, book_loans IN SHARE ROW EXCLUSIVE MODE;
+        UPDATE genre_facets f SET copies = c.copies
+        FROM (SELECT coalesce(genre, '') AS genre, sum(quantity)::int AS copies
+              FROM books GROUP BY 1) c
+        WHERE f.genre = c.genre;
+        TRUNCATE circulation_deltas, loans_daily, book_circulation, genre_circulation;
+        INSERT INTO loans_daily (day, loans, returns)
+        SELECT day, sum(loans), sum(returns) FROM (
+            SELECT loan_date::date AS day, count(*) AS loans, 0 AS returns
+            FROM book_loans GROUP BY 1
+            UNION ALL
+            SELECT coalesce(return_date, loan_date)::date, 0, count(*)
+            FROM book_loans WHERE is_returned GROUP BY 1
+        ) d GROUP BY day;
+        INSERT INTO book_circulation (book_id, genre, loans, on_loan)
+        SELECT l.book_id, coalesce(min(b.genre), ''), count(*),
+               count(*) FILTER (WHERE NOT l.is_returned)
+        FROM book_loans l LEFT JOIN books b ON b.id = l.book_id
+        GROUP BY l.book_id;
+        INSERT INTO genre_circulation (genre, loans, on_loan)
+        SELECT genre, sum(loans), sum(on_loan) FROM book_circulation GROUP BY genre;
+    '''),
+    (13, 'Версии книг для оптимистичной блокировки', '''
+        -- Версия растет только при правке карточки книги; выдачи и возвраты
+        -- ее не меняют, чтобы инвентаризация не конфликтовала с обслуживанием
+        ALTER TABLE books ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+    '''),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+async def current_version(conn) -> int:
+    try:
+        return await conn.fetchval('SELECT coalesce(max(version), 0) FROM schema_version')
+    except asyncpg.UndefinedTableError:
+        return 0
+
+async def migrate(conn) -> int:
+    # Обычный запуск: один запрос и никакого DDL
+    version = await current_version(conn)
+    if version >= LATEST_VERSION:
+        logger.info("Схема базы данных актуальна (версия %s)", version)
+        return version
+
+    async with conn.transaction():
+        await conn.execute('SELECT pg_advisory_xact_lock($1)', MIGRATION_LOCK_KEY,
+                           timeout=MAINTENANCE_TIMEOUT)
+        await conn.execute('SET LOCAL statement_timeout = 0')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Пока ждали блокировку, миграции мог применить другой процесс
+        version = await current_version(conn)
+        for number, description, sql in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info("Применение миграции %s: %s", number, description)
+            await conn.execute(sql, timeout=MAINTENANCE_TIMEOUT)
+            await conn.execute(
+                'INSERT INTO schema_version (version, description) VALUES ($1, $2)',
+                number, description
+            )
+            version = number
+    logger.info("Схема базы данных обновлена до версии %s", version)
+    return version
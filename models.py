@@ -0,0 +1,109 @@
+from datetime import date, datetime
+from typing import NamedTuple, Optional
+
+# Строки каталога хранятся кортежами: без словаря атрибутов на экземпляр
+# и без копии имен колонок, которые asyncpg.Record держит в описании строки.
+# Порядок полей совпадает с порядком колонок проекций в request.py,
+# поэтому модель строится из записи напрямую: Model(*record).
+
+class BookSummary(NamedTuple):
+    id: int
+    title: str
+    author_name: Optional[str]
+    available_quantity: int
+
+class BookDetail(NamedTuple):
+    id: int
+    title: str
+    author_id: Optional[int]
+    author_name: Optional[str]
+    genre: Optional[str]
+    description: Optional[str]
+    quantity: int
+    available_quantity: int
+
+class Author(NamedTuple):
+    id: int
+    name: str
+    biography: Optional[str]
+
+class AuthorMatch(NamedTuple):
+    id: int
+    name: str
+    book_count: int
+
+class GenreFacet(NamedTuple):
+    genre: str
+    total: int
+    available: int
+
+class AuthorFacet(NamedTuple):
+    author_id: int
+    name: str
+    total: int
+    available: int
+
+class DailyLoans(NamedTuple):
+    day: date
+    loans: int
+    returns: int
+
+class BookCirculation(NamedTuple):
+    book_id: int
+    title: str
+    loans: int
+    on_loan: int
+
+class GenreUtilization(NamedTuple):
+    genre: str
+    copies: int
+    on_loan: int
+    utilization: Optional[float]
+
+class LoanSummary(NamedTuple):
+    id: int
+    book_id: int
+    title: str
+    loan_date: datetime
+    due_date: datetime
+    return_date: Optional[datetime]
+    is_returned: bool
+    is_overdue: bool
+
+class OverdueLoan(NamedTuple):
+    id: int
+    book_id: int
+    title: str
+    user_id: int
+    username: str
+    loan_date: datetime
+    due_date: datetime
+
+class BookEdit(NamedTuple):
+    id: int
+    title: str
+    author_id: Optional[int]
+    genre: Optional[str]
+    description: Optional[str]
+    quantity: int
+    available_quantity: int
+    version: int
+
+class EditResult(NamedTuple):
+    # status: updated, conflict (версия устарела), insufficient (экземпляров
+    # на руках больше нового количества) или missing (книги нет)
+    id: int
+    status: str
+    version: Optional[int]
+    available_quantity: Optional[int]
+
+# Колонки проекций; books соединяется с authors под псевдонимами b и a
+BOOK_SUMMARY_COLUMNS = 'b.id, b.title, a.name AS author_name, b.available_quantity'
+BOOK_DETAIL_COLUMNS = ('b.id, b.title, b.author_id, a.name AS author_name, b.genre, '
+                       'b.description, b.quantity, b.available_quantity')
+AUTHOR_COLUMNS = 'id, name, biography'
+# Выдачи: book_loans - l, books - b, users - u
+LOAN_SUMMARY_COLUMNS = ('l.id, l.book_id, b.title, l.loan_date, l.due_date, l.return_date, '
+                        'l.is_returned, '
+                        '(NOT l.is_returned AND l.due_date < CURRENT_TIMESTAMP) AS is_overdue')
+OVERDUE_LOAN_COLUMNS = 'l.id, l.book_id, b.title, l.user_id, u.username, l.loan_date, l.due_date'
@@ -1,200 +1,1071 @@
+import asyncio
+import base64
+import csv
 import hashlib
+import hmac
+import json
+import logging
+import os
+import re
 import secrets
+import time
 import asyncpg
+from concurrent.futures import ThreadPoolExecutor
 
+import cache
 from db import db_instance
+from migrations import MAINTENANCE_TIMEOUT
+from models import (BookSummary, BookDetail, Author, AuthorMatch, GenreFacet, AuthorFacet,
+                    BookEdit, EditResult, LoanSummary, OverdueLoan,
+                    BOOK_SUMMARY_COLUMNS, BOOK_DETAIL_COLUMNS, AUTHOR_COLUMNS,
+                    LOAN_SUMMARY_COLUMNS, OVERDUE_LOAN_COLUMNS)
 
-SECRET_KEY = '8fa0f1b045a6337d95427211ba8d719c05a5e157b7ee705a948aaf8356d6524e'
+logger = logging.getLogger(__name__)
+
+RESERVATIONS_CHANNEL = 'library_reservations'
+AVAILABILITY_CHANNEL = 'library_availability'
+
+# Ключ подписи токенов сессий. Без него токены не выдаются и не принимаются,
+# а server.py не запускается; сгенерировать ключ: generate_secret_key()
+SECRET_KEY = os.environ.get('LIBRARY_SECRET_KEY') or None
+
+# Стоимость scrypt: время и память растут линейно с SCRYPT_N
+SCRYPT_N = int(os.environ.get('LIBRARY_SCRYPT_N', 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+SESSION_TTL = int(os.environ.get('LIBRARY_SESSION_TTL', 12 * 3600))
+
+# hashlib.scrypt отпускает GIL, поэтому хеширование в потоках не блокирует
+# event loop и масштабируется по ядрам
+_kdf_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='kdf')
 
 def generate_secret_key(length=32):
     return secrets.token_hex(length)
 
 def hash_data(data):
-    new_data = data + SECRET_KEY
-    return hashlib.sha256(new_data.encode()).hexdigest()
+    if not SECRET_KEY:
+        raise RuntimeError("Не задан LIBRARY_SECRET_KEY")
+    return hmac.new(SECRET_KEY.encode(), data.encode(), hashlib.sha256).hexdigest()
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024, dklen=32)
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+def hash_password(password: str, n: int = None) -> str:
+    n = n or SCRYPT_N
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, n, SCRYPT_R, SCRYPT_P)
+    return f'scrypt${n}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}'
+
+def verify_password(password: str, stored: str) -> bool:
+    if stored.startswith('scrypt$'):
+        _, n, r, p, salt, digest = stored.split('$')
+        computed = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(computed.hex(), digest)
+    # Старые записи: несоленый SHA-256, пересчитываются при следующем входе
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+def password_needs_rehash(stored: str) -> bool:
+    return not stored.startswith(f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$')
+
+async def _run_kdf(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_kdf_executor, func, *args)
+
+def issue_session_token(user_id: int, username: str, is_admin: bool, ttl: int = None) -> str:
+    expires_at = int(time.time()) + (ttl or SESSION_TTL)
+    payload = f'{user_id}:{int(is_admin)}:{expires_at}:{username}'
+    encoded = base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+    return f'{encoded}.{hash_data(encoded)}'
+
+def verify_session_token(token: str):
+    if not token or not SECRET_KEY:
+        return None
+    encoded, _, signature = token.rpartition('.')
+    if not encoded or not hmac.compare_digest(signature, hash_data(encoded)):
+        return None
+    try:
+        payload = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).decode()
+        user_id, is_admin, expires_at, username = payload.split(':', 3)
+    except ValueError:
+        return None
+    if int(expires_at) < time.time():
+        return None
+    return {'id': int(user_id), 'username': username, 'is_admin': is_admin == '1'}
+
+def require_session(token: str, admin: bool = False) -> dict:
+    # Проверка прав по подписанному токену, без обращения к таблице users
+    user = verify_session_token(token)
+    if user is None:
+        raise PermissionError("Сессия недействительна или истекла")
+    if admin and not user['is_admin']:
+        raise PermissionError("Недостаточно прав")
+    return user
 
 async def add_user(username: str, password: str, is_admin: bool = False):
     if not username or not password:
         raise ValueError("Имя пользователя и пароль обязательны")
     
     try:
-        pool = await db_instance.get_pool()
-        hashed_password = hash_password(password)
+        hashed_password = await _run_kdf(hash_password, password)
         
-        async with pool.acquire() as conn:
+        async with db_instance.acquire() as conn:
             try:
-                print(f"Попытка добавить пользователя: {username}")
+                logger.debug("Попытка добавить пользователя: %s", username)
                 await conn.execute(
                     'INSERT INTO users (username, password, is_admin) VALUES ($1, $2, $3)',
                     username, hashed_password, is_admin
                 )
-                print(f"Пользователь {username} успешно добавлен")
+                logger.info("Пользователь %s успешно добавлен", username)
             except asyncpg.UniqueViolationError:
-                print(f"Пользователь {username} уже существует")
+                logger.info("Пользователь %s уже существует", username)
                 raise ValueError(f"Пользователь {username} уже существует")
             except Exception as e:
-                print(f"Ошибка при добавлении пользователя в БД: {str(e)}")
+                logger.error("Ошибка при добавлении пользователя в БД: %s", e)
                 raise ValueError(f"Ошибка при добавлении пользователя: {str(e)}")
     except Exception as e:
-        print(f"Ошибка при подключении к БД: {str(e)}")
+        logger.error("Ошибка при подключении к БД: %s", e)
         raise ValueError(f"Ошибка подключения к базе данных: {str(e)}")
 
 async def user_exists(username: str) -> bool:
     if not username:
         return False
     
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+    async with db_instance.acquire() as conn:
         try:
             result = await conn.fetchval('SELECT id FROM users WHERE username = $1', username)
             return result is not None
         except Exception as e:
-            print(f"Ошибка при проверке существования пользователя: {e}")
+            logger.error("Ошибка при проверке существования пользователя: %s", e)
             raise e
 
 async def authenticate_user(username: str, password: str):
     if not username or not password:
         return None
     
-    pool = await db_instance.get_pool()
-    hashed_password = hash_password(password)
-    
-    async with pool.acquire() as conn:
+    # Соединение не удерживается на время scrypt: пачка входов иначе
+    # займет весь пул, и выдачи с каталогом будут ждать в очереди
+    async with db_instance.acquire() as conn:
         try:
             user = await conn.fetchrow(
-                'SELECT id, username, is_admin FROM users WHERE username = $1 AND password = $2',
-                username, hashed_password
+                'SELECT id, username, is_admin, password FROM users WHERE username = $1',
+                username
             )
-            return user
         except Exception as e:
-            print(f"Ошибка при аутентификации пользователя: {e}")
+            logger.error("Ошибка при аутентификации пользователя: %s", e)
             raise e
+    if user is None or not await _run_kdf(verify_password, password, user['password']):
+        return None
+    if password_needs_rehash(user['password']):
+        hashed_password = await _run_kdf(hash_password, password)
+        async with db_instance.acquire() as conn:
+            try:
+                # Хеш меняется, только если его не успел обновить параллельный вход
+                await conn.execute(
+                    'UPDATE users SET password = $1 WHERE id = $2 AND password = $3',
+                    hashed_password, user['id'], user['password']
+                )
+            except Exception as e:
+                logger.error("Ошибка при обновлении хеша пароля: %s", e)
+                raise e
+    return {
+        'id': user['id'],
+        'username': user['username'],
+        'is_admin': user['is_admin'],
+        # Приложению с прямым подключением к базе токен не нужен
+        'token': issue_session_token(user['id'], user['username'], user['is_admin'])
+                 if SECRET_KEY else None,
+    }
 
 async def add_book(title: str, author_id: int, genre: str, description: str, quantity: int):
     if not title or not author_id:
         raise ValueError("Название книги и ID автора обязательны")
     
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+    async with db_instance.acquire() as conn:
         try:
             await conn.execute(
                 '''INSERT INTO books (title, author_id, genre, description, quantity, available_quantity)
                    VALUES ($1, $2, $3, $4, $5, $5)''',
                 title, author_id, genre, description, quantity
             )
+            cache.invalidate_book()
         except Exception as e:
-            print(f"Ошибка при добавлении книги: {e}")
+            logger.error("Ошибка при добавлении книги: %s", e)
             raise e
 
-async def update_book(book_id, title, author_id, genre, description, quantity):
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
-        await conn.execute(
-            '''UPDATE books SET title = $1, author_id = $2, genre = $3, 
-               description = $4, quantity = $5 WHERE id = $6''',
-            title, author_id, genre, description, quantity, book_id
-        )
+BOOK_EDIT_FIELDS = ('title', 'author_id', 'genre', 'description', 'quantity')
+
+async def update_book(book_id, title, author_id, genre, description, quantity,
+                      version: int = None) -> EditResult:
+    # Без version правка применяется к текущей версии книги
+    edit = {'id': book_id, 'title': title, 'author_id': author_id, 'genre': genre,
+            'description': description, 'quantity': quantity}
+    if version is not None:
+        edit['version'] = version
+    return (await update_books([edit]))[0]
+
+async def update_books(edits: list) -> list:
+    # Каждая правка - словарь с id, ожидаемой version и изменяемыми полями
+    # из BOOK_EDIT_FIELDS; отсутствующие поля не меняются. Все правки
+    # применяются одним оператором, результат - EditResult на каждую правку
+    if not edits:
+        return []
+    ids = [edit['id'] for edit in edits]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Книга встречается в пакете правок несколько раз")
+    for edit in edits:
+        if edit.get('quantity') is not None and int(edit['quantity']) < 0:
+            raise ValueError(f"Отрицательное количество у книги {edit['id']}")
+        if not edit.get('title', True):
+            raise ValueError(f"Пустое название у книги {edit['id']}")
+    payload = json.dumps([
+        {key: edit[key] for key in ('id', 'version') + BOOK_EDIT_FIELDS if key in edit}
+        for edit in edits
+    ], ensure_ascii=False)
+    
+    async with db_instance.acquire() as conn:
+        try:
+            # Строки блокируются по возрастанию id, как при пакетной выдаче.
+            # Остаток в наличии сдвигается на изменение количества; уменьшить
+            # количество ниже числа экземпляров на руках нельзя
+            rows = await conn.fetch(
+                '''WITH edits AS (
+                       SELECT (e->>'id')::int AS id, (e->>'version')::int AS version,
+                              (e->>'quantity')::int AS quantity, e
+                       FROM jsonb_array_elements($1::jsonb) AS e
+                   ), locked AS (
+                       SELECT b.id, b.version, b.quantity, b.available_quantity
+                       FROM books b JOIN edits x ON x.id = b.id
+                       ORDER BY b.id
+                       FOR UPDATE OF b
+                   ), checked AS (
+                       SELECT x.id, x.e, l.version AS current_version,
+                              coalesce(x.quantity, l.quantity) AS quantity,
+                              l.available_quantity + coalesce(x.quantity, l.quantity) - l.quantity
+                                  AS available_quantity,
+                              CASE
+                                  WHEN l.id IS NULL THEN 'missing'
+                                  WHEN x.version IS NOT NULL AND x.version <> l.version THEN 'conflict'
+                                  WHEN l.available_quantity + coalesce(x.quantity, l.quantity)
+                                       - l.quantity < 0 THEN 'insufficient'
+                                  ELSE 'updated'
+                              END AS status
+                       FROM edits x LEFT JOIN locked l ON l.id = x.id
+                   ), updated AS (
+                       UPDATE books b SET
+                           title = CASE WHEN c.e ? 'title' THEN c.e->>'title' ELSE b.title END,
+                           author_id = CASE WHEN c.e ? 'author_id'
+                                            THEN (c.e->>'author_id')::int ELSE b.author_id END,
+                           genre = CASE WHEN c.e ? 'genre' THEN c.e->>'genre' ELSE b.genre END,
+                           description = CASE WHEN c.e ? 'description'
+                                              THEN c.e->>'description' ELSE b.description END,
+                           quantity = c.quantity,
+                           available_quantity = c.available_quantity,
+                           version = b.version + 1
+                       FROM checked c
+                       WHERE b.id = c.id AND c.status = 'updated'
+                       RETURNING b.id, b.version, b.available_quantity
+                   )
+                   SELECT c.id, c.status,
+                          coalesce(u.version, c.current_version) AS version,
+                          coalesce(u.available_quantity, c.available_quantity) AS available_quantity
+                   FROM checked c LEFT JOIN updated u ON u.id = c.id''',
+                payload
+            )
+            results = {row['id']: EditResult(*row) for row in rows}
+            for result in results.values():
+                if result.status == 'updated':
+                    cache.invalidate_book(result.id)
+            return [results[book_id] for book_id in ids]
+        except Exception as e:
+            logger.error("Ошибка при пакетной правке книг: %s", e)
+            raise e
+
+async def get_books_for_edit(after_id: int = 0, limit: int = 100, filters: dict = None):
+    # Страница карточек с версиями для массовой правки; читается с основного
+    # сервера, чтобы версии не отставали от реплики
+    params = [after_id]
+    conditions = ['b.id > $1'] + _books_where(filters, params)
+    params.append(limit)
+    async with db_instance.acquire() as conn:
+        try:
+            books = await conn.fetch(
+                f'''SELECT b.id, b.title, b.author_id, b.genre, b.description,
+                           b.quantity, b.available_quantity, b.version
+                    FROM books b
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY b.id LIMIT ${len(params)}''',
+                *params
+            )
+            return [BookEdit(*book) for book in books]
+        except Exception as e:
+            logger.error("Ошибка при получении книг для правки: %s", e)
+            raise e
 
 async def get_all_books():
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            books = await conn.fetch(
+                f'''SELECT {BOOK_SUMMARY_COLUMNS} FROM books b 
+                    LEFT JOIN authors a ON b.author_id = a.id'''
+            )
+            return [BookSummary(*book) for book in books]
+        except Exception as e:
+            logger.error("Ошибка при получении списка книг: %s", e)
+            raise e
+
+def _books_where(filters, params):
+    conditions = []
+    if filters:
+        if filters.get('author_id') is not None:
+            params.append(filters['author_id'])
+            conditions.append(f'b.author_id = ${len(params)}')
+        if filters.get('genre'):
+            params.append(filters['genre'])
+            conditions.append(f'b.genre = ${len(params)}')
+        if filters.get('available_only'):
+            conditions.append('b.available_quantity > 0')
+    return conditions
+
+async def get_books_page(after_id: int = 0, limit: int = 50, filters: dict = None):
+    cache_key = (after_id, limit, tuple(sorted(filters.items())) if filters else None)
+    page = cache.catalog_cache.get(cache_key)
+    if page is not None:
+        return page
+    generation = cache.catalog_cache.generation
+    readonly = cache.read_from_replica(cache.catalog_cache)
+    
+    params = [after_id]
+    conditions = ['b.id > $1'] + _books_where(filters, params)
+    params.append(limit)
+    
+    async with db_instance.acquire(readonly=readonly) as conn:
+        try:
+            books = await conn.fetch(
+                f'''SELECT {BOOK_SUMMARY_COLUMNS} FROM books b 
+                    LEFT JOIN authors a ON b.author_id = a.id
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY b.id LIMIT ${len(params)}''',
+                *params
+            )
+            page = [BookSummary(*book) for book in books]
+            cache.catalog_cache.set(cache_key, page, generation)
+            return page
+        except Exception as e:
+            logger.error("Ошибка при получении страницы книг: %s", e)
+            raise e
+
+async def get_genre_facets(author_id: int = None):
+    # Счетчики читаются из таблиц, которые ведут триггеры books, а не
+    # считаются по books на каждый запрос
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            if author_id is not None:
+                facets = await conn.fetch(
+                    '''SELECT genre, total, available FROM book_facets
+                       WHERE author_id = $1 AND genre <> '' AND total > 0
+                       ORDER BY genre''',
+                    author_id
+                )
+            else:
+                facets = await conn.fetch(
+                    '''SELECT genre, total, available FROM genre_facets
+                       WHERE genre <> '' AND total > 0 ORDER BY genre'''
+                )
+            return [GenreFacet(*facet) for facet in facets]
+        except Exception as e:
+            logger.error("Ошибка при получении фасетов по жанрам: %s", e)
+            raise e
+
+async def get_author_facets(genre: str = None, limit: int = 50):
+    # Авторы с наибольшим числом книг, по всему каталогу или в жанре
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            if genre:
+                facets = await conn.fetch(
+                    '''SELECT f.author_id, a.name, f.total, f.available
+                       FROM book_facets f JOIN authors a ON a.id = f.author_id
+                       WHERE f.genre = $1 AND f.total > 0
+                       ORDER BY f.total DESC, f.author_id LIMIT $2''',
+                    genre, limit
+                )
+            else:
+                facets = await conn.fetch(
+                    '''SELECT f.author_id, a.name, f.total, f.available
+                       FROM author_facets f JOIN authors a ON a.id = f.author_id
+                       WHERE f.total > 0
+                       ORDER BY f.total DESC, f.author_id LIMIT $1''',
+                    limit
+                )
+            return [AuthorFacet(*facet) for facet in facets]
+        except Exception as e:
+            logger.error("Ошибка при получении фасетов по авторам: %s", e)
+            raise e
+
+async def iter_books(filters: dict = None, prefetch: int = 500):
+    params = []
+    conditions = _books_where(filters, params)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    
+    async with db_instance.acquire(readonly=True) as conn:
         try:
-            return await conn.fetch(
-                '''SELECT b.*, a.name as author_name FROM books b 
-                   LEFT JOIN authors a ON b.author_id = a.id'''
+            # Серверный курсор живет только внутри транзакции
+            async with conn.transaction(readonly=True):
+                async for book in conn.cursor(
+                    f'''SELECT {BOOK_DETAIL_COLUMNS} FROM books b 
+                        LEFT JOIN authors a ON b.author_id = a.id
+                        {where} ORDER BY b.id''',
+                    *params, prefetch=prefetch
+                ):
+                    yield BookDetail(*book)
+        except Exception as e:
+            logger.error("Ошибка при выгрузке списка книг: %s", e)
+            raise e
+
+def _prefix_tsquery(query: str) -> str:
+    # Каждое слово ищем как префикс, чтобы поиск работал прямо при наборе
+    words = re.findall(r'\w+', query)
+    return ' & '.join(f'{word}:*' for word in words)
+
+# Более короткий префикс совпадает с заметной долей каталога, и ранжирование
+# уже не укладывается в миллисекунды. Каждая ветка поиска отдает не больше
+# SEARCH_CANDIDATES лучших совпадений
+SEARCH_MIN_LENGTH = 3
+SEARCH_CANDIDATES = 1000
+
+async def search_books(query: str, limit: int = 50):
+    query = (query or '').strip()
+    if len(query) < SEARCH_MIN_LENGTH:
+        return []
+    tsquery = _prefix_tsquery(query)
+    if not tsquery:
+        return []
+    
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            # Обе ветки используют свои GIN-индексы: по search_vector книг
+            # и триграммный по именам авторов. Имя автора сравнивается по
+            # word_similarity: при наборе запрос - лишь часть имени
+            books = await conn.fetch(
+                f'''WITH text_matches AS (
+                       SELECT b.id, ts_rank(b.search_vector, to_tsquery('simple', $1)) AS rank
+                       FROM books b
+                       WHERE b.search_vector @@ to_tsquery('simple', $1)
+                       ORDER BY rank DESC LIMIT $4
+                   ), author_matches AS (
+                       SELECT b.id, word_similarity($2, a.name) AS rank
+                       FROM authors a JOIN books b ON b.author_id = a.id
+                       WHERE $2 <% a.name
+                       ORDER BY $2 <<-> a.name LIMIT $4
+                   ), matches AS (
+                       -- ts_rank не ограничен сверху, поэтому приводится к доле
+                       -- лучшего совпадения; word_similarity уже лежит в [0, 1]
+                       SELECT id, coalesce(rank / nullif(max(rank) OVER (), 0), 0) AS rank
+                       FROM text_matches
+                       UNION ALL
+                       SELECT id, rank FROM author_matches
+                   ), best AS (
+                       SELECT id, max(rank) AS rank FROM matches
+                       GROUP BY id ORDER BY rank DESC, id LIMIT $3
+                   )
+                   SELECT {BOOK_SUMMARY_COLUMNS} FROM best
+                   JOIN books b ON b.id = best.id
+                   LEFT JOIN authors a ON b.author_id = a.id
+                   ORDER BY best.rank DESC, b.id''',
+                tsquery, query, limit, SEARCH_CANDIDATES
             )
+            return [BookSummary(*book) for book in books]
         except Exception as e:
-            print(f"Ошибка при получении списка книг: {e}")
+            logger.error("Ошибка при поиске книг: %s", e)
+            raise e
+
+async def get_catalog_changes(table: str, since: int, after_id: int = 0, limit: int = 5000):
+    # Строки, измененные транзакциями начиная с since, страницами по ключу
+    # (change_xid, id). horizon - xmin снимка, взятого до чтения строк: все
+    # транзакции ниже него завершены, поэтому следующая синхронизация может
+    # начинаться с horizon и ничего не пропустит
+    columns = {
+        'books': 'id, title, author_id, genre, description, quantity, available_quantity',
+        'authors': 'id, name',
+    }[table]
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            horizon = await conn.fetchval(
+                'SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint'
+            )
+            rows = await conn.fetch(
+                f'''SELECT {columns}, change_xid::text::bigint AS change_xid FROM {table}
+                    WHERE (change_xid, id) > ($1::text::xid8, $2)
+                    ORDER BY change_xid, id LIMIT $3''',
+                str(since), after_id, limit
+            )
+            return {'horizon': horizon, 'rows': rows}
+        except Exception as e:
+            logger.error("Ошибка при получении изменений каталога: %s", e)
             raise e
 
 async def get_book(book_id: int):
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+    book = cache.book_cache.get(book_id)
+    if book is not None:
+        return book
+    generation = cache.book_cache.generation
+    readonly = cache.read_from_replica(cache.book_cache, book_id)
+    
+    async with db_instance.acquire(readonly=readonly) as conn:
         try:
-            return await conn.fetchrow(
-                '''SELECT b.*, a.name as author_name FROM books b 
-                   LEFT JOIN authors a ON b.author_id = a.id WHERE b.id = $1''',
+            record = await conn.fetchrow(
+                f'''SELECT {BOOK_DETAIL_COLUMNS} FROM books b 
+                    LEFT JOIN authors a ON b.author_id = a.id WHERE b.id = $1''',
                 book_id
             )
+            if record is None:
+                return None
+            book = BookDetail(*record)
+            cache.book_cache.set(book_id, book, generation)
+            return book
         except Exception as e:
-            print(f"Ошибка при получении информации о книге: {e}")
+            logger.error("Ошибка при получении информации о книге: %s", e)
             raise e
 
 async def add_author(name: str, biography: str = None):
     if not name:
         raise ValueError("Имя автора обязательно")
     
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+    async with db_instance.acquire() as conn:
         try:
             await conn.execute(
                 'INSERT INTO authors (name, biography) VALUES ($1, $2)',
                 name, biography
             )
+            cache.invalidate_author()
         except Exception as e:
-            print(f"Ошибка при добавлении автора: {e}")
+            logger.error("Ошибка при добавлении автора: %s", e)
             raise e
 
 async def get_all_authors():
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+    authors = cache.authors_list_cache.get(None)
+    if authors is not None:
+        return authors
+    generation = cache.authors_list_cache.generation
+    readonly = cache.read_from_replica(cache.authors_list_cache)
+    
+    async with db_instance.acquire(readonly=readonly) as conn:
+        try:
+            authors = [Author(*author) for author in
+                       await conn.fetch(f'SELECT {AUTHOR_COLUMNS} FROM authors')]
+            cache.authors_list_cache.set(None, authors, generation)
+            return authors
+        except Exception as e:
+            logger.error("Ошибка при получении списка авторов: %s", e)
+            raise e
+
+def _prefix_range(text: str):
+    # Все строки с префиксом text лежат в [text, text с увеличенным последним символом)
+    text = text.lower()
+    return text, text[:-1] + chr(ord(text[-1]) + 1)
+
+async def lookup_authors(query: str, limit: int = 10):
+    query = (query or '').strip()
+    if not query:
+        return []
+    
+    # Биографии не читаются: автодополнению нужны только id, имя и число книг.
+    # Число книг считается по индексу books (author_id, id) для найденных авторов
+    async with db_instance.acquire(readonly=True) as conn:
         try:
-            return await conn.fetch('SELECT * FROM authors')
+            records = await conn.fetch(
+                '''SELECT a.id, a.name,
+                          (SELECT count(*) FROM books b WHERE b.author_id = a.id) AS book_count
+                   FROM authors a
+                   WHERE lower(a.name) COLLATE "C" >= $1 AND lower(a.name) COLLATE "C" < $2
+                   ORDER BY lower(a.name) COLLATE "C", a.id LIMIT $3''',
+                *_prefix_range(query), limit
+            )
+            # Префиксных совпадений мало - добираем похожие по триграммам имена,
+            # в том числе совпадения с началом фамилии в середине имени
+            if len(records) < limit and len(query) >= 3:
+                records += await conn.fetch(
+                    '''SELECT a.id, a.name,
+                              (SELECT count(*) FROM books b WHERE b.author_id = a.id) AS book_count
+                       FROM authors a
+                       WHERE $1 <% a.name AND a.id <> ALL($2::int[])
+                       ORDER BY word_similarity($1, a.name) DESC, a.id LIMIT $3''',
+                    query, [record['id'] for record in records], limit - len(records)
+                )
+            return [AuthorMatch(*record) for record in records]
         except Exception as e:
-            print(f"��шибка при получении списка авторов: {e}")
+            logger.error("Ошибка при поиске авторов: %s", e)
             raise e
 
 async def get_author(author_id: int):
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+    author = cache.author_cache.get(author_id)
+    if author is not None:
+        return author
+    generation = cache.author_cache.generation
+    readonly = cache.read_from_replica(cache.author_cache, author_id)
+    
+    async with db_instance.acquire(readonly=readonly) as conn:
         try:
-            return await conn.fetchrow('SELECT * FROM authors WHERE id = $1', author_id)
+            record = await conn.fetchrow(
+                f'SELECT {AUTHOR_COLUMNS} FROM authors WHERE id = $1', author_id
+            )
+            if record is None:
+                return None
+            author = Author(*record)
+            cache.author_cache.set(author_id, author, generation)
+            return author
         except Exception as e:
-            print(f"Ошибка при получении информации об авторе: {e}")
+            logger.error("Ошибка при получении информации об авторе: %s", e)
             raise e
 
 async def borrow_book(book_id: int, user_id: int) -> bool:
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+    async with db_instance.acquire() as conn:
         try:
-            book = await conn.fetchrow(
-                'SELECT available_quantity FROM books WHERE id = $1',
-                book_id
+            # Списание экземпляра и запись о выдаче выполняются одним оператором:
+            # условие на остаток проверяется под блокировкой строки, поэтому
+            # параллельные выдачи не уводят его в минус. Экземпляры, на которые
+            # есть очередь броней, достаются очереди, а не читателю у полки
+            loan_id = await conn.fetchval(
+                '''WITH taken AS (
+                       UPDATE books SET available_quantity = available_quantity - 1
+                       WHERE id = $1 AND available_quantity > (
+                           SELECT count(*) FROM reservations r
+                           WHERE r.book_id = $1 AND r.status = 'waiting'
+                       )
+                       RETURNING id
+                   )
+                   INSERT INTO book_loans (book_id, user_id, loan_date)
+                   SELECT id, $2, CURRENT_TIMESTAMP FROM taken
+                   RETURNING id''',
+                book_id, user_id
             )
-            if book and book['available_quantity'] > 0:
-                async with conn.transaction():
-                    await conn.execute(
-                        'UPDATE books SET available_quantity = available_quantity - 1 WHERE id = $1',
-                        book_id
-                    )
-                    await conn.execute(
-                        '''INSERT INTO book_loans (book_id, user_id, loan_date)
-                           VALUES ($1, $2, CURRENT_TIMESTAMP)''',
-                        book_id, user_id
-                    )
-                    return True
-            return False
+            if loan_id is None:
+                return False
+            cache.invalidate_book(book_id)
+            return True
         except Exception as e:
-            print(f"Ошибка при попытке взять книгу: {e}")
+            logger.error("Ошибка при попытке взять книгу: %s", e)
             raise e
 
-async def return_book(book_id: int, user_id: int):
-    pool = await db_instance.get_pool()
-    async with pool.acquire() as conn:
+async def return_book(book_id: int, user_id: int) -> bool:
+    async with db_instance.acquire() as conn:
         try:
-            async with conn.transaction():
-                await conn.execute(
-                    '''UPDATE book_loans SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP
-                       WHERE book_id = $1 AND user_id = $2 AND is_returned = FALSE''',
+            # Закрывается одна, самая ранняя, выдача, и остаток растет ровно на
+            # число действительно закрытых выдач. Строка книги блокируется
+            # раньше строки выдачи - в том же порядке, что и в пакетных операциях
+            returned = await conn.fetchval(
+                '''WITH book AS (
+                       SELECT id FROM books WHERE id = $1 FOR UPDATE
+                   ), loan AS (
+                       SELECT l.id FROM book_loans l JOIN book ON book.id = l.book_id
+                       WHERE l.user_id = $2 AND l.is_returned = FALSE
+                       ORDER BY l.loan_date, l.id LIMIT 1
+                       FOR UPDATE OF l
+                   ), returned AS (
+                       UPDATE book_loans l SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP
+                       FROM loan WHERE l.id = loan.id
+                       RETURNING l.book_id
+                   )
+                   UPDATE books b SET available_quantity = b.available_quantity + 1
+                   FROM returned WHERE b.id = returned.book_id
+                   RETURNING b.id''',
+                book_id, user_id
+            )
+            if returned is None:
+                return False
+            cache.invalidate_book(book_id)
+            return True
+        except Exception as e:
+            logger.error("Ошибка при возврате книги: %s", e)
+            raise e
+
+async def return_loan(loan_id: int, user_id: int = None) -> bool:
+    async with db_instance.acquire() as conn:
+        try:
+            # user_id ограничивает возврат выдачами самого пользователя;
+            # None - возврат любой выдачи со стойки администратора
+            book_id = await conn.fetchval(
+                '''WITH loan AS (
+                       SELECT id, book_id FROM book_loans
+                       WHERE id = $1 AND is_returned = FALSE
+                         AND ($2::int IS NULL OR user_id = $2)
+                   ), book AS (
+                       SELECT b.id FROM books b JOIN loan ON loan.book_id = b.id
+                       FOR UPDATE OF b
+                   ), returned AS (
+                       UPDATE book_loans l SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP
+                       FROM loan JOIN book ON book.id = loan.book_id
+                       WHERE l.id = loan.id AND l.is_returned = FALSE
+                       RETURNING l.book_id
+                   )
+                   UPDATE books b SET available_quantity = b.available_quantity + 1
+                   FROM returned WHERE b.id = returned.book_id
+                   RETURNING b.id''',
+                loan_id, user_id
+            )
+            if book_id is None:
+                return False
+            cache.invalidate_book(book_id)
+            return True
+        except Exception as e:
+            logger.error("Ошибка при возврате выдачи: %s", e)
+            raise e
+
+async def get_user_loans(user_id: int, before_id: int = None, limit: int = 50,
+                         open_only: bool = False):
+    async with db_instance.acquire() as conn:
+        try:
+            # Постраничный просмотр от новых выдач к старым по индексу (user_id, id DESC);
+            # условия собираются заранее, чтобы поиск начинался сразу с ключа страницы
+            params = [user_id, limit]
+            conditions = ['l.user_id = $1']
+            if before_id is not None:
+                params.append(before_id)
+                conditions.append(f'l.id < ${len(params)}')
+            if open_only:
+                conditions.append('l.is_returned = FALSE')
+            rows = await conn.fetch(
+                f'''SELECT {LOAN_SUMMARY_COLUMNS}
+                    FROM book_loans l JOIN books b ON b.id = l.book_id
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY l.id DESC LIMIT $2''',
+                *params
+            )
+            return [LoanSummary(*row) for row in rows]
+        except Exception as e:
+            logger.error("Ошибка при получении истории выдач: %s", e)
+            raise e
+
+async def get_overdue_loans(after_due=None, after_id: int = 0, limit: int = 50):
+    async with db_instance.acquire(readonly=True) as conn:
+        try:
+            # Ключ страницы - (due_date, id) последней строки предыдущей страницы
+            params = [limit]
+            seek = ''
+            if after_due is not None:
+                params += [after_due, after_id]
+                seek = 'AND (l.due_date, l.id) > ($2, $3)'
+            rows = await conn.fetch(
+                f'''SELECT {OVERDUE_LOAN_COLUMNS}
+                    FROM book_loans l
+                    JOIN books b ON b.id = l.book_id
+                    JOIN users u ON u.id = l.user_id
+                    WHERE l.is_returned = FALSE AND l.due_date < CURRENT_TIMESTAMP {seek}
+                    ORDER BY l.due_date, l.id LIMIT $1''',
+                *params
+            )
+            return [OverdueLoan(*row) for row in rows]
+        except Exception as e:
+            logger.error("Ошибка при получении просроченных выдач: %s", e)
+            raise e
+
+async def reserve_book(book_id: int, user_id: int):
+    async with db_instance.acquire() as conn:
+        try:
+            # Повторная бронь той же книги возвращает место существующей;
+            # уведомление будит диспетчер на случай, если экземпляр уже свободен
+            row = await conn.fetchrow(
+                '''WITH inserted AS (
+                       INSERT INTO reservations (book_id, user_id) VALUES ($1, $2)
+                       ON CONFLICT (user_id, book_id) WHERE status = 'waiting' DO NOTHING
+                       RETURNING id
+                   ), reservation AS (
+                       SELECT id FROM inserted
+                       UNION ALL
+                       SELECT id FROM reservations
+                       WHERE book_id = $1 AND user_id = $2 AND status = 'waiting'
+                   )
+                   SELECT reservation.id,
+                          -- только что вставленная строка не видна подзапросу
+                          (SELECT count(*) FROM reservations q
+                           WHERE q.book_id = $1 AND q.status = 'waiting'
+                             AND q.id <= reservation.id) + (SELECT count(*) FROM inserted)
+                              AS position,
+                          pg_notify($3, $1::text)
+                   FROM reservation LIMIT 1''',
+                book_id, user_id, RESERVATIONS_CHANNEL
+            )
+            if row is None:
+                # Параллельная такая же бронь зафиксирована после снимка
+                # оператора: ON CONFLICT ее уже видит, а выборка - еще нет
+                row = await conn.fetchrow(
+                    '''SELECT r.id,
+                              (SELECT count(*) FROM reservations q
+                               WHERE q.book_id = r.book_id AND q.status = 'waiting'
+                                 AND q.id <= r.id) AS position
+                       FROM reservations r
+                       WHERE r.book_id = $1 AND r.user_id = $2
+                         AND r.status = 'waiting' ''',
                     book_id, user_id
                 )
-                await conn.execute(
-                    'UPDATE books SET available_quantity = available_quantity + 1 WHERE id = $1',
-                    book_id
-                )
+            if row is None:
+                # Бронь успели выдать или отменить между двумя запросами
+                raise ValueError("Книга уже забронирована, повторите попытку")
+            return {'id': row['id'], 'position': row['position']}
         except Exception as e:
-            print(f"Ошибка при возврате книги: {e}")
+            logger.error("Ошибка при бронировании книги: %s", e)
             raise e
+
+async def cancel_reservation(reservation_id: int, user_id: int) -> bool:
+    async with db_instance.acquire() as conn:
+        try:
+            result = await conn.fetchval(
+                '''UPDATE reservations SET status = 'cancelled'
+                   WHERE id = $1 AND user_id = $2 AND status = 'waiting'
+                   RETURNING id''',
+                reservation_id, user_id
+            )
+            return result is not None
+        except Exception as e:
+            logger.error("Ошибка при отмене брони: %s", e)
+            raise e
+
+async def dispatch_reservation(book_id: int = None):
+    book_filter = 'AND r.book_id = $1' if book_id is not None else ''
+    params = [book_id] if book_id is not None else []
+    async with db_instance.acquire() as conn:
+        try:
+            # SKIP LOCKED позволяет нескольким диспетчерам разбирать очередь
+            # параллельно: каждый берет первую бронь, не занятую другими
+            return await conn.fetchrow(
+                f'''WITH next AS (
+                        SELECT r.id, r.book_id, r.user_id
+                        FROM reservations r
+                        WHERE r.status = 'waiting' {book_filter}
+                          AND EXISTS (
+                              SELECT 1 FROM books b
+                              WHERE b.id = r.book_id AND b.available_quantity > 0
+                          )
+                        ORDER BY r.id LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    ), taken AS (
+                        UPDATE books b SET available_quantity = b.available_quantity - 1
+                        FROM next WHERE b.id = next.book_id AND b.available_quantity > 0
+                        RETURNING b.id
+                    ), loan AS (
+                        INSERT INTO book_loans (book_id, user_id, loan_date)
+                        SELECT next.book_id, next.user_id, CURRENT_TIMESTAMP
+                        FROM next JOIN taken ON taken.id = next.book_id
+                        RETURNING id
+                    )
+                    UPDATE reservations r
+                    SET status = 'fulfilled', loan_id = loan.id, fulfilled_at = CURRENT_TIMESTAMP
+                    FROM next, loan
+                    WHERE r.id = next.id
+                    RETURNING r.id, r.book_id, r.user_id, r.loan_id''',
+                *params
+            )
+        except Exception as e:
+            logger.error("Ошибка при выдаче забронированной книги: %s", e)
+            raise e
+
+async def dispatch_reservations(book_id: int = None, limit: int = 100) -> list:
+    fulfilled = []
+    while len(fulfilled) < limit:
+        reservation = await dispatch_reservation(book_id)
+        if reservation is None:
+            break
+        cache.invalidate_book(reservation['book_id'])
+        fulfilled.append(reservation)
+    return fulfilled
+
+def _per_item_results(book_ids, counts: dict):
+    # Повторы одной книги в пакете удовлетворяются по порядку, пока хватает
+    # обработанных экземпляров
+    remaining = dict(counts)
+    results = []
+    for book_id in book_ids:
+        ok = remaining.get(book_id, 0) > 0
+        if ok:
+            remaining[book_id] -= 1
+        results.append((book_id, ok))
+    return results
+
+async def borrow_books(user_id: int, book_ids: list) -> list:
+    if not book_ids:
+        return []
+    
+    async with db_instance.acquire() as conn:
+        try:
+            # Один оператор на всю стопку: строки книг блокируются по возрастанию id,
+            # поэтому параллельные пакеты не взаимоблокируются
+            rows = await conn.fetch(
+                '''WITH requested AS (
+                       SELECT book_id, count(*)::int AS wanted
+                       FROM unnest($2::int[]) AS book_id
+                       GROUP BY book_id
+                   ), locked AS (
+                       SELECT b.id, b.available_quantity
+                       FROM books b JOIN requested r ON r.book_id = b.id
+                       ORDER BY b.id
+                       FOR UPDATE OF b
+                   ), free AS (
+                       SELECT l.id, l.available_quantity - (
+                           SELECT count(*) FROM reservations q
+                           WHERE q.book_id = l.id AND q.status = 'waiting'
+                       ) AS n
+                       FROM locked l
+                   ), granted AS (
+                       SELECT f.id AS book_id, LEAST(r.wanted, f.n) AS n
+                       FROM free f JOIN requested r ON r.book_id = f.id
+                       WHERE f.n > 0
+                   ), taken AS (
+                       UPDATE books b SET available_quantity = b.available_quantity - g.n
+                       FROM granted g WHERE b.id = g.book_id
+                       RETURNING b.id
+                   ), loans AS (
+                       INSERT INTO book_loans (book_id, user_id, loan_date)
+                       SELECT g.book_id, $1, CURRENT_TIMESTAMP
+                       FROM granted g CROSS JOIN LATERAL generate_series(1, g.n)
+                       RETURNING book_id
+                   )
+                   SELECT book_id, count(*)::int AS n FROM loans GROUP BY book_id''',
+                user_id, book_ids
+            )
+            counts = {row['book_id']: row['n'] for row in rows}
+            for book_id in counts:
+                cache.invalidate_book(book_id)
+            return _per_item_results(book_ids, counts)
+        except Exception as e:
+            logger.error("Ошибка при пакетной выдаче книг: %s", e)
+            raise e
+
+async def return_books(user_id: int, book_ids: list) -> list:
+    if not book_ids:
+        return []
+    
+    async with db_instance.acquire() as conn:
+        try:
+            # Для каждой книги закрываются самые ранние открытые выдачи пользователя
+            rows = await conn.fetch(
+                '''WITH requested AS (
+                       SELECT book_id, count(*)::int AS wanted
+                       FROM unnest($2::int[]) AS book_id
+                       GROUP BY book_id
+                   ), locked AS (
+                       SELECT b.id
+                       FROM books b JOIN requested r ON r.book_id = b.id
+                       ORDER BY b.id
+                       FOR UPDATE OF b
+                   ), open_loans AS (
+                       SELECT l.id, l.book_id,
+                              row_number() OVER (PARTITION BY l.book_id ORDER BY l.loan_date, l.id) AS rn
+                       FROM book_loans l JOIN locked k ON k.id = l.book_id
+                       WHERE l.user_id = $1 AND l.is_returned = FALSE
+                   ), returned AS (
+                       UPDATE book_loans l SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP
+                       FROM open_loans o JOIN requested r ON r.book_id = o.book_id
+                       WHERE l.id = o.id AND o.rn <= r.wanted AND l.is_returned = FALSE
+                       RETURNING l.book_id
+                   ), counts AS (
+                       SELECT book_id, count(*)::int AS n FROM returned GROUP BY book_id
+                   ), restocked AS (
+                       UPDATE books b SET available_quantity = b.available_quantity + c.n
+                       FROM counts c WHERE b.id = c.book_id
+                       RETURNING b.id
+                   )
+                   SELECT book_id, n FROM counts''',
+                user_id, book_ids
+            )
+            counts = {row['book_id']: row['n'] for row in rows}
+            for book_id in counts:
+                cache.invalidate_book(book_id)
+            return _per_item_results(book_ids, counts)
+        except Exception as e:
+            logger.error("Ошибка при пакетном возврате книг: %s", e)
+            raise e
+
+def _read_records(path: str):
+    if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, encoding='utf-8', newline='') as f:
+            yield from csv.DictReader(f)
+
+def _batches(records, size: int):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def _resolve_author_ids(conn, names, author_ids: dict):
+    missing = sorted({name for name in names if name not in author_ids})
+    if not missing:
+        return
+    rows = await conn.fetch(
+        '''SELECT DISTINCT ON (name) name, id FROM authors
+           WHERE name = ANY($1::text[]) ORDER BY name, id''',
+        missing
+    )
+    author_ids.update((row['name'], row['id']) for row in rows)
+    missing = [name for name in missing if name not in author_ids]
+    if missing:
+        rows = await conn.fetch(
+            'INSERT INTO authors (name) SELECT unnest($1::text[]) RETURNING name, id',
+            missing
+        )
+        author_ids.update((row['name'], row['id']) for row in rows)
+
+async def import_catalog(authors_path: str = None, books_path: str = None,
+                         batch_size: int = 10000, progress=None) -> dict:
+    stats = {'authors': 0, 'books': 0}
+    started = time.perf_counter()
+    author_ids = {}
+    
+    def report(table, count):
+        stats[table] += count
+        if progress:
+            elapsed = time.perf_counter() - started
+            progress(table, stats[table], stats[table] / elapsed if elapsed else 0.0)
+    
+    async with db_instance.acquire() as conn:
+        try:
+            if authors_path:
+                for batch in _batches(_read_records(authors_path), batch_size):
+                    async with conn.transaction():
+                        await conn.execute('SET LOCAL statement_timeout = 0')
+                        await conn.copy_records_to_table(
+                            'authors',
+                            records=[(r['name'], r.get('biography') or None) for r in batch],
+                            columns=['name', 'biography'],
+                            timeout=MAINTENANCE_TIMEOUT
+                        )
+                    report('authors', len(batch))
+            
+            if books_path:
+                for batch in _batches(_read_records(books_path), batch_size):
+                    async with conn.transaction():
+                        await conn.execute('SET LOCAL statement_timeout = 0')
+                        # Имена авторов разрешаются в ID одним запросом на пакет
+                        await _resolve_author_ids(
+                            conn, [r['author'] for r in batch if not r.get('author_id')], author_ids
+                        )
+                        records = []
+                        for r in batch:
+                            author_id = int(r['author_id']) if r.get('author_id') else author_ids[r['author']]
+                            quantity = int(r.get('quantity') or 1)
+                            records.append((r['title'], author_id, r.get('genre') or None,
+                                            r.get('description') or None, quantity, quantity))
+                        await conn.copy_records_to_table(
+                            'books',
+                            records=records,
+                            columns=['title', 'author_id', 'genre', 'description',
+                                     'quantity', 'available_quantity'],
+                            timeout=MAINTENANCE_TIMEOUT
+                        )
+                    report('books', len(batch))
+        except Exception as e:
+            logger.error("Ошибка при импорте каталога: %s", e)
+            raise e
+    
+    cache.invalidate_author()
+    stats['seconds'] = time.perf_counter() - started
+    total = stats['authors'] + stats['books']
+    stats['rows_per_sec'] = total / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
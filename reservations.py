@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from db import db_instance
+from request import RESERVATIONS_CHANNEL, dispatch_reservations
+
+logger = logging.getLogger(__name__)
+
+# Диспетчер очереди броней. Запускается отдельным процессом:
+#     python reservations.py --workers 4
+# Процессов и обработчиков может быть несколько: брони разбираются через
+# FOR UPDATE SKIP LOCKED, поэтому они не мешают друг другу.
+class ReservationDispatcher:
+    # Периодический проход страхует от уведомлений, пропущенных при переподключении
+    SWEEP_INTERVAL = 30
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self._queue = asyncio.Queue()
+        self._tasks = []
+
+    async def start(self):
+        # После обрыва LISTEN очередь проходится целиком, не дожидаясь _sweep
+        await db_instance.add_listener(RESERVATIONS_CHANNEL, self._on_notify,
+                                       on_reconnect=lambda: self._queue.put_nowait(None))
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+        logger.info("Диспетчер броней запущен, обработчиков: %s", self.workers)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._queue.put_nowait(int(payload))
+
+    async def _dispatch(self, book_id):
+        try:
+            fulfilled = await dispatch_reservations(book_id)
+        except Exception as e:
+            logger.error("Ошибка диспетчера броней: %s", e)
+            return
+        for reservation in fulfilled:
+            logger.info("Бронь %s: книга %s выдана пользователю %s",
+                        reservation['id'], reservation['book_id'], reservation['user_id'])
+
+    async def _worker(self):
+        while True:
+            book_id = await self._queue.get()
+            await self._dispatch(book_id)
+
+    async def _sweep(self):
+        while True:
+            await self._dispatch(None)
+            await asyncio.sleep(self.SWEEP_INTERVAL)
+
+async def run(workers: int):
+    dispatcher = ReservationDispatcher(workers)
+    await db_instance.create_pool()
+    await dispatcher.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await dispatcher.stop()
+        await db_instance.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description='Диспетчер очереди броней')
+    parser.add_argument('--workers', type=int, default=2, help='параллельных обработчиков')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=os.environ.get('LIBRARY_LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+    )
+    try:
+        asyncio.run(run(args.workers))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import asyncio
+
+# Загрузки данных экранов. Каждая задача принадлежит владельцу (экрану) и
+# занимает у него слот: новая загрузка в тот же слот отменяет предыдущую,
+# уход с экрана отменяет все его загрузки. Отмена задачи прерывает и запрос
+# к базе - asyncpg отправляет серверу cancel. Одинаковые запросы, идущие
+# одновременно, выполняются один раз, а результат получают все ожидающие.
+class TaskScheduler:
+    def __init__(self, spawn, max_per_owner: int = 2):
+        # spawn(coro, name) -> Task; у приложения он же замеряет задержку
+        self._spawn = spawn
+        self.max_per_owner = max_per_owner
+        self._slots = {}
+        self._limits = {}
+        self._shared = {}
+
+    def submit(self, owner, slot: str, factory, name: str):
+        # factory() создает корутину загрузки уже после того, как освободится
+        # место в лимите владельца
+        previous = self._slots.get((owner, slot))
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = self._spawn(self._limited(owner, factory), name)
+        self._slots[(owner, slot)] = task
+
+        def release(task):
+            if self._slots.get((owner, slot)) is task:
+                del self._slots[(owner, slot)]
+        task.add_done_callback(release)
+        return task
+
+    async def _limited(self, owner, factory):
+        limit = self._limits.get(owner)
+        if limit is None:
+            limit = self._limits[owner] = asyncio.Semaphore(self.max_per_owner)
+        async with limit:
+            return await factory()
+
+    def cancel(self, owner, slot: str = None):
+        # Без slot отменяются все загрузки владельца
+        for (task_owner, task_slot), task in list(self._slots.items()):
+            if task_owner is owner and slot in (None, task_slot):
+                task.cancel()
+
+    async def shared(self, key, factory):
+        # factory() создает корутину запроса; она запускается, только если
+        # такого же запроса сейчас нет. Запрос отменяется, когда его перестали
+        # ждать все присоединившиеся
+        entry = self._shared.get(key)
+        if entry is None:
+            entry = self._shared[key] = [asyncio.ensure_future(factory()), 0]
+
+            def forget(task, entry=entry):
+                if self._shared.get(key) is entry:
+                    del self._shared[key]
+            entry[0].add_done_callback(forget)
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # Отменяемый запрос сразу убирается из общих: новый такой же
+                # запрос не должен присоединиться к нему и получить отмену
+                if self._shared.get(key) is entry:
+                    del self._shared[key]
+                task.cancel()
@@ -0,0 +1,332 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from datetime import date, datetime
+
+from aiohttp import web
+
+import analytics
+import cache
+from db import db_instance
+from request import (add_user, user_exists, authenticate_user, add_book, get_books_page,
+                     search_books, get_book, add_author, lookup_authors, get_author,
+                     borrow_book, return_book, return_loan, get_user_loans, get_overdue_loans,
+                     reserve_book, borrow_books, return_books, get_catalog_changes,
+                     get_genre_facets, get_author_facets, update_books, get_books_for_edit,
+                     require_session, AVAILABILITY_CHANNEL, SECRET_KEY)
+
+logger = logging.getLogger(__name__)
+
+# HTTP-сервис над request.py. Клиенты (main.py с LIBRARY_API_URL) ходят сюда,
+# а к Postgres подключается только сервис - одним общим пулом. Экземпляров
+# сервиса может быть несколько: кэши согласуются через LISTEN library_cache.
+#     python server.py --port 8080 --pool-max 20
+MAX_PAGE = 500
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Тип {type(value).__name__} не сериализуется в JSON")
+
+def _plain(value):
+    # Модели - именованные кортежи, записи asyncpg - отображения
+    if hasattr(value, '_asdict'):
+        return value._asdict()
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if hasattr(value, 'keys'):
+        return dict(value)
+    return value
+
+def json_response(data, status: int = 200):
+    return web.json_response(
+        _plain(data), status=status,
+        dumps=lambda obj: json.dumps(obj, default=_json_default, ensure_ascii=False)
+    )
+
+@web.middleware
+async def error_middleware(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except PermissionError as e:
+        return json_response({'error': str(e)}, status=403)
+    except (ValueError, KeyError) as e:
+        return json_response({'error': str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Ошибка обработки %s %s: %s", request.method, request.path, e)
+        return json_response({'error': 'Внутренняя ошибка сервера'}, status=500)
+
+def session(request, admin: bool = False) -> dict:
+    header = request.headers.get('Authorization', '')
+    token = header[len('Bearer '):] if header.startswith('Bearer ') else None
+    return require_session(token, admin)
+
+def _int_arg(request, name: str, default=None):
+    value = request.query.get(name)
+    return int(value) if value not in (None, '') else default
+
+def _limit(request, default: int = 50) -> int:
+    return max(1, min(_int_arg(request, 'limit', default), MAX_PAGE))
+
+def _flag(value) -> bool:
+    return str(value).lower() in ('1', 'true', 'yes')
+
+async def health(request):
+    pool = await db_instance.get_pool()
+    return json_response({
+        'pool_size': pool.get_size(),
+        'pool_idle': pool.get_idle_size(),
+        'cache': cache.stats(),
+    })
+
+async def login(request):
+    body = await request.json()
+    user = await authenticate_user(body.get('username'), body.get('password'))
+    if user is None:
+        return json_response({'error': 'Неверный логин или пароль'}, status=401)
+    return json_response(user)
+
+async def register(request):
+    body = await request.json()
+    is_admin = bool(body.get('is_admin'))
+    # Открытая регистрация создает только читателей
+    if is_admin:
+        session(request, admin=True)
+    await add_user(body.get('username'), body.get('password'), is_admin)
+    return json_response({'ok': True}, status=201)
+
+async def check_user(request):
+    return json_response({'exists': await user_exists(request.query.get('username'))})
+
+async def books_page(request):
+    filters = {
+        'author_id': _int_arg(request, 'author_id'),
+        'genre': request.query.get('genre'),
+        'available_only': _flag(request.query.get('available_only')),
+    }
+    filters = {key: value for key, value in filters.items() if value}
+    return json_response(await get_books_page(_int_arg(request, 'after_id', 0), _limit(request),
+                                              filters or None))
+
+async def genre_facets(request):
+    return json_response(await get_genre_facets(_int_arg(request, 'author_id')))
+
+async def author_facets(request):
+    return json_response(await get_author_facets(request.query.get('genre') or None,
+                                                 _limit(request)))
+
+async def books_search(request):
+    return json_response(await search_books(request.query.get('q', ''), _limit(request)))
+
+async def book_details(request):
+    book = await get_book(int(request.match_info['book_id']))
+    if book is None:
+        return json_response({'error': 'Книга не найдена'}, status=404)
+    return json_response(book)
+
+async def create_book(request):
+    session(request, admin=True)
+    body = await request.json()
+    await add_book(body['title'], int(body['author_id']), body.get('genre'),
+                   body.get('description'), int(body.get('quantity', 1)))
+    return json_response({'ok': True}, status=201)
+
+async def books_for_edit(request):
+    session(request, admin=True)
+    filters = {'genre': request.query.get('genre'), 'author_id': _int_arg(request, 'author_id')}
+    filters = {key: value for key, value in filters.items() if value}
+    return json_response(await get_books_for_edit(_int_arg(request, 'after_id', 0),
+                                                  _limit(request, default=100), filters or None))
+
+async def edit_books(request):
+    session(request, admin=True)
+    body = await request.json()
+    return json_response(await update_books(body['edits']))
+
+async def borrow(request):
+    user = session(request)
+    return json_response({'ok': await borrow_book(int(request.match_info['book_id']), user['id'])})
+
+async def give_back(request):
+    user = session(request)
+    return json_response({'ok': await return_book(int(request.match_info['book_id']), user['id'])})
+
+async def reserve(request):
+    user = session(request)
+    return json_response(await reserve_book(int(request.match_info['book_id']), user['id']))
+
+async def borrow_batch(request):
+    user = session(request)
+    body = await request.json()
+    return json_response(await borrow_books(user['id'], [int(i) for i in body['book_ids']]))
+
+async def return_batch(request):
+    user = session(request)
+    body = await request.json()
+    return json_response(await return_books(user['id'], [int(i) for i in body['book_ids']]))
+
+async def user_loans(request):
+    user = session(request)
+    return json_response(await get_user_loans(user['id'], _int_arg(request, 'before_id'),
+                                              _limit(request),
+                                              open_only=_flag(request.query.get('open_only'))))
+
+async def overdue_loans(request):
+    session(request, admin=True)
+    after_due = request.query.get('after_due')
+    return json_response(await get_overdue_loans(
+        datetime.fromisoformat(after_due) if after_due else None,
+        _int_arg(request, 'after_id', 0), _limit(request)
+    ))
+
+async def close_loan(request):
+    user = session(request)
+    # Администратор со стойки возвращает любую выдачу, читатель - только свою
+    user_id = None if user['is_admin'] else user['id']
+    return json_response({'ok': await return_loan(int(request.match_info['loan_id']), user_id)})
+
+async def authors_lookup(request):
+    return json_response(await lookup_authors(request.query.get('q', ''),
+                                              _limit(request, default=10)))
+
+async def author_details(request):
+    author = await get_author(int(request.match_info['author_id']))
+    if author is None:
+        return json_response({'error': 'Автор не найден'}, status=404)
+    return json_response(author)
+
+async def create_author(request):
+    session(request, admin=True)
+    body = await request.json()
+    await add_author(body.get('name'), body.get('biography'))
+    return json_response({'ok': True}, status=201)
+
+async def stats_daily(request):
+    session(request, admin=True)
+    return json_response(await analytics.loans_per_day(_int_arg(request, 'days', 30)))
+
+async def stats_top_books(request):
+    session(request, admin=True)
+    return json_response(await analytics.top_books(_limit(request, default=10)))
+
+async def stats_genres(request):
+    session(request, admin=True)
+    return json_response(await analytics.genre_utilization())
+
+async def catalog_changes(request):
+    # Каталог и так открыт через /api/books; изменения, как и его страницы,
+    # отдаются не больше чем по MAX_PAGE строк - снимок приложения синхронизируется
+    # и до входа пользователя
+    table = request.query.get('table')
+    if table not in ('books', 'authors'):
+        raise ValueError("Неизвестная таблица каталога")
+    return json_response(await get_catalog_changes(table, _int_arg(request, 'since', 0),
+                                                   _int_arg(request, 'after_id', 0),
+                                                   _limit(request, default=MAX_PAGE)))
+
+async def events(request):
+    # Изменения наличия книг рассылаются клиентам по websocket в формате
+    # уведомлений базы: "<book_id>:<available_quantity>"
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    subscribers = request.app['subscribers']
+    subscribers.add(ws)
+    try:
+        async for _ in ws:
+            pass
+    finally:
+        subscribers.discard(ws)
+    return ws
+
+def broadcast(app, payload: str):
+    for ws in list(app['subscribers']):
+        task = asyncio.create_task(ws.send_str(payload))
+        app['sends'].add(task)
+        task.add_done_callback(app['sends'].discard)
+
+async def on_startup(app):
+    await db_instance.create_pool()
+    await cache.start_invalidation_listener()
+    await db_instance.add_listener(
+        AVAILABILITY_CHANNEL,
+        lambda connection, pid, channel, payload: broadcast(app, payload)
+    )
+    logger.info("Сервис запущен, пул соединений: %s-%s",
+                db_instance.settings['min_size'], db_instance.settings['max_size'])
+
+async def on_shutdown(app):
+    for ws in list(app['subscribers']):
+        await ws.close()
+
+async def on_cleanup(app):
+    await db_instance.close_pool()
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[error_middleware])
+    app['subscribers'] = set()
+    app['sends'] = set()
+    app.add_routes([
+        web.get('/api/health', health),
+        web.post('/api/login', login),
+        web.post('/api/users', register),
+        web.get('/api/users/exists', check_user),
+        web.get('/api/books', books_page),
+        web.post('/api/books', create_book),
+        web.get('/api/books/search', books_search),
+        web.get('/api/facets/genres', genre_facets),
+        web.get('/api/facets/authors', author_facets),
+        web.post('/api/books/borrow', borrow_batch),
+        web.post('/api/books/return', return_batch),
+        web.get('/api/books/edit', books_for_edit),
+        web.post('/api/books/edit', edit_books),
+        web.get('/api/books/{book_id:\\d+}', book_details),
+        web.post('/api/books/{book_id:\\d+}/borrow', borrow),
+        web.post('/api/books/{book_id:\\d+}/return', give_back),
+        web.post('/api/books/{book_id:\\d+}/reserve', reserve),
+        web.get('/api/loans', user_loans),
+        web.get('/api/loans/overdue', overdue_loans),
+        web.post('/api/loans/{loan_id:\\d+}/return', close_loan),
+        web.get('/api/authors/lookup', authors_lookup),
+        web.post('/api/authors', create_author),
+        web.get('/api/authors/{author_id:\\d+}', author_details),
+        web.get('/api/catalog/changes', catalog_changes),
+        web.get('/api/stats/daily', stats_daily),
+        web.get('/api/stats/top-books', stats_top_books),
+        web.get('/api/stats/genres', stats_genres),
+        web.get('/api/events', events),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP/JSON сервис библиотеки')
+    parser.add_argument('--host', default=os.environ.get('LIBRARY_API_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('LIBRARY_API_PORT', 8080)))
+    parser.add_argument('--pool-min', type=int, help='минимум соединений пула (по умолчанию из настроек)')
+    parser.add_argument('--pool-max', type=int, help='максимум соединений пула (по умолчанию из настроек)')
+    args = parser.parse_args()
+    if not SECRET_KEY:
+        parser.error('задайте LIBRARY_SECRET_KEY: без него токены сессий не подписываются')
+
+    logging.basicConfig(
+        level=os.environ.get('LIBRARY_LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+    )
+    if args.pool_min is not None:
+        db_instance.settings['min_size'] = args.pool_min
+    if args.pool_max is not None:
+        db_instance.settings['max_size'] = args.pool_max
+    # Обработчик отменяется, когда клиент разорвал соединение: загрузка,
+    # отмененная в приложении, прерывает и запрос к базе на сервисе
+    web.run_app(create_app(), host=args.host, port=args.port, handler_cancellation=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from models import BookSummary, BookDetail, BOOK_SUMMARY_COLUMNS, BOOK_DETAIL_COLUMNS
+from request import get_catalog_changes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.library', 'catalog.sqlite3')
+
+# Версия формата файла снимка (PRAGMA user_version) для будущих изменений схемы
+SNAPSHOT_VERSION = 1
+
+class CatalogSnapshot:
+    SYNC_BATCH = 5000
+
+    def __init__(self, path: str = None, fetch_changes=None):
+        self.path = path or os.environ.get('LIBRARY_SNAPSHOT_PATH', DEFAULT_PATH)
+        # Источник изменений: request.py напрямую или client.py через сервис
+        self.fetch_changes = fetch_changes or get_catalog_changes
+        self.ready = False
+        self._conn = None
+        # Все обращения к SQLite идут из одного потока, вне event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self):
+        await self._run(self._open)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS authors (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS books (
+                id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                author_id INTEGER,
+                genre TEXT,
+                description TEXT,
+                quantity INTEGER,
+                available_quantity INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS books_genre_idx ON books (genre, id);
+            CREATE INDEX IF NOT EXISTS books_author_id_idx ON books (author_id, id);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                name TEXT PRIMARY KEY,
+                horizon INTEGER NOT NULL
+            );
+        ''')
+        self._conn.execute(f'PRAGMA user_version = {SNAPSHOT_VERSION}')
+        self.ready = self._conn.execute('SELECT count(*) FROM sync_state').fetchone()[0] > 0
+
+    def _since(self, table: str) -> int:
+        row = self._conn.execute(
+            'SELECT horizon FROM sync_state WHERE name = ?', (table,)
+        ).fetchone()
+        return row['horizon'] if row else 0
+
+    def _apply(self, table: str, rows: list):
+        columns = list(rows[0].keys())
+        columns.remove('change_xid')
+        with self._conn:
+            self._conn.executemany(
+                f'''INSERT OR REPLACE INTO {table} ({', '.join(columns)})
+                    VALUES ({', '.join('?' * len(columns))})''',
+                [tuple(row[column] for column in columns) for row in rows]
+            )
+
+    def _save_horizon(self, table: str, horizon: int):
+        with self._conn:
+            self._conn.execute(
+                '''INSERT INTO sync_state (name, horizon) VALUES (?, ?)
+                   ON CONFLICT (name) DO UPDATE SET horizon = excluded.horizon''',
+                (table, horizon)
+            )
+
+    async def sync(self) -> int:
+        # После первой полной загрузки тянутся только строки, измененные
+        # транзакциями, которые не были завершены к прошлой синхронизации.
+        # Граница сохраняется после всех страниц: прерванная синхронизация
+        # повторится с прежней границы
+        pulled = 0
+        for table in ('authors', 'books'):
+            since = await self._run(self._since, table)
+            horizon = None
+            change_xid, after_id = since, 0
+            while True:
+                changes = await self.fetch_changes(table, change_xid, after_id, self.SYNC_BATCH)
+                if horizon is None:
+                    horizon = changes['horizon']
+                rows = changes['rows']
+                # Сервис может отдавать страницы меньше SYNC_BATCH, поэтому
+                # изменения кончаются только на пустой странице
+                if not rows:
+                    break
+                await self._run(self._apply, table, [dict(row) for row in rows])
+                change_xid, after_id = rows[-1]['change_xid'], rows[-1]['id']
+                pulled += len(rows)
+            await self._run(self._save_horizon, table, horizon)
+        self.ready = True
+        logger.info("Снимок каталога синхронизирован, получено строк: %s", pulled)
+        return pulled
+
+    def _get_books_page(self, after_id: int, limit: int, filters: dict):
+        # Снимок отдает те же модели и понимает те же фильтры, что и request.py
+        conditions = ['b.id > ?']
+        params = [after_id]
+        if filters:
+            if filters.get('author_id') is not None:
+                conditions.append('b.author_id = ?')
+                params.append(filters['author_id'])
+            if filters.get('genre'):
+                conditions.append('b.genre = ?')
+                params.append(filters['genre'])
+            if filters.get('available_only'):
+                conditions.append('b.available_quantity > 0')
+        rows = self._conn.execute(
+            f'''SELECT {BOOK_SUMMARY_COLUMNS} FROM books b
+                LEFT JOIN authors a ON b.author_id = a.id
+                WHERE {' AND '.join(conditions)} ORDER BY b.id LIMIT ?''',
+            params + [limit]
+        ).fetchall()
+        return [BookSummary(*row) for row in rows]
+
+    async def get_books_page(self, after_id: int = 0, limit: int = 50, filters: dict = None):
+        return await self._run(self._get_books_page, after_id, limit, filters)
+
+    def _get_book(self, book_id: int):
+        row = self._conn.execute(
+            f'''SELECT {BOOK_DETAIL_COLUMNS} FROM books b
+                LEFT JOIN authors a ON b.author_id = a.id WHERE b.id = ?''',
+            (book_id,)
+        ).fetchone()
+        return BookDetail(*row) if row is not None else None
+
+    async def get_book(self, book_id: int):
+        return await self._run(self._get_book, book_id)
+
+    def _set_availability(self, book_id: int, available_quantity: int):
+        with self._conn:
+            self._conn.execute(
+                'UPDATE books SET available_quantity = ? WHERE id = ?',
+                (available_quantity, book_id)
+            )
+
+    async def set_availability(self, book_id: int, available_quantity: int):
+        await self._run(self._set_availability, book_id, available_quantity)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
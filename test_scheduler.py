@@ -0,0 +1,57 @@
+import asyncio
+import unittest
+
+from scheduler import TaskScheduler
+
+def spawn(coro, name):
+    return asyncio.get_running_loop().create_task(coro, name=name)
+
+class CancelTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancel_slot_keeps_other_slots(self):
+        scheduler = TaskScheduler(spawn)
+        authors = scheduler.submit('admin', 'authors', lambda: asyncio.sleep(1), 'authors')
+        stats = scheduler.submit('admin', 'stats', lambda: asyncio.sleep(0.01), 'stats')
+        scheduler.cancel('admin', 'authors')
+        with self.assertRaises(asyncio.CancelledError):
+            await authors
+        await stats
+        self.assertFalse(stats.cancelled())
+
+class SharedTest(unittest.IsolatedAsyncioTestCase):
+    async def test_rejoin_after_cancel_starts_new_query(self):
+        # Уход с экрана и быстрый возврат: первая загрузка отменена, а вторая
+        # такая же не должна присоединиться к отменяемому запросу
+        scheduler = TaskScheduler(spawn)
+        started = []
+
+        async def query():
+            started.append(1)
+            await asyncio.sleep(0.05)
+            return 'rows'
+
+        first = spawn(scheduler.shared('page', query), 'first')
+        await asyncio.sleep(0)
+        first.cancel()
+        second = spawn(scheduler.shared('page', query), 'second')
+
+        self.assertEqual(await second, 'rows')
+        self.assertEqual(len(started), 2)
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+    async def test_concurrent_waiters_share_one_query(self):
+        scheduler = TaskScheduler(spawn)
+        started = []
+
+        async def query():
+            started.append(1)
+            await asyncio.sleep(0.01)
+            return 'rows'
+
+        results = await asyncio.gather(scheduler.shared('page', query),
+                                       scheduler.shared('page', query))
+        self.assertEqual(results, ['rows', 'rows'])
+        self.assertEqual(len(started), 1)
+
+if __name__ == '__main__':
+    unittest.main()